@@ -1,16 +1,29 @@
 #!/usr/bin/env python
+import os
 import re
+import sys
 import argparse
+import copy
 import pysam
-import pandas as pd
 # from ssw import AlignmentMgr
-from pyssw.ssw_wrap import Aligner
-from Bio.Seq import Seq
 import random
 import multiprocessing
-from tqdm import tqdm
+import queue
+import threading
 import time
-from SLRanger.visualization import visualize_html
+import zlib
+from bisect import bisect_right
+from tqdm import tqdm
+from collections import Counter, OrderedDict, deque
+from itertools import islice
+from SLRanger.aligner import AlignerPool
+from SLRanger.sorted_writer import SortedResultWriter
+from SLRanger.checkpoint import Checkpoint
+from SLRanger.profiling import StageProfiler, profile_table, report_profile
+from SLRanger.sl_index import write_index, load_index
+from SLRanger.columnar import MINIMAL_COLUMNS, INT_COLUMNS, SCORE_COLUMNS, require_pyarrow, tsv_to_parquet
+from SLRanger.shard import (parse_shard, in_shard, sl_checksum, file_fingerprint, write_partial_metadata,
+                            merge_partials)
 
 def fasta_to_dict(fasta_path):
     fasta_dict = {}
@@ -120,26 +133,67 @@ def longest_consecutive(nums):
 
     return longest_streak, max_end_value
 
-def find_best_match(query, mismatch_to_kmer, kmer_to_refs, k):
-    encoded_query = [query[i:i+k] for i in range(len(query) - k + 1)]
-    ref_positions = []
+# 2-bit coding of k-mers, bases outside ACGT break the k-mer
+KMER_BASE_CODE = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+
+def encode_kmer(kmer):
+    code = 0
+    for base in kmer:
+        if base not in KMER_BASE_CODE:
+            return None
+        code = (code << 2) | KMER_BASE_CODE[base]
+    return code
+
+def build_kmer_index(kmer_to_refs, mismatch_to_kmer, k):
+    """
+    position index of one reference for find_best_match
+    kmer_index[code] is the tuple of reference positions hit by the query k-mer with that 2-bit code:
+    - a k-mer of the reference hits all its positions
+    - otherwise a 1-mismatch neighbour from build_mismatch_index hits the first position of its original k-mer
+    """
+    positions = {}
+    for index, kmer in enumerate(kmer_to_refs):
+        positions.setdefault(kmer, []).append(index)
+
+    kmer_index = [None] * (4 ** k)
+    for mismatch, original_kmer in mismatch_to_kmer.items():
+        code = encode_kmer(mismatch)
+        if code is not None and original_kmer in positions:
+            kmer_index[code] = (positions[original_kmer][0],)
+    for kmer, kmer_positions in positions.items():
+        code = encode_kmer(kmer)
+        if code is not None:
+            kmer_index[code] = tuple(kmer_positions)
+    return kmer_index
+
+def build_kmer_indexes(kmer, mismatch_to_kmer, k):
+    return {key: build_kmer_index(kmer_to_refs, mismatch_to_kmer, k) for key, kmer_to_refs in kmer.items()}
+
+def find_best_match(query, kmer_index, k):
+    """
+    k-mer support of the query on one reference, kmer_index comes from build_kmer_index
+    the query k-mers are 2-bit encoded on the fly, so each base is visited once
+    """
+    ref_positions = set()
     max_consecutive = 0
     best_consecutive_end = 0
 
-    for query_kmer in encoded_query:
-        if query_kmer in kmer_to_refs:
-            if kmer_to_refs.count(query_kmer) > 1:
-                ref_positions.extend(index for index, kmer in enumerate(kmer_to_refs) if kmer == query_kmer)
-            else:
-                ref_positions.append(kmer_to_refs.index(query_kmer))
-        elif query_kmer in mismatch_to_kmer:
-            original_kmer = mismatch_to_kmer[query_kmer]
-            if original_kmer in kmer_to_refs:
-                if kmer_to_refs.count(query_kmer) > 1:
-                    ref_positions.extend(index for index, kmer in enumerate(kmer_to_refs) if kmer == original_kmer)
-                else:
-                    ref_positions.append(kmer_to_refs.index(original_kmer))
-    max_intersection = len(set(ref_positions))
+    mask = (1 << (2 * k)) - 1
+    code = 0
+    valid = 0
+    for base in query:
+        base_code = KMER_BASE_CODE.get(base)
+        if base_code is None:
+            code = 0
+            valid = 0
+            continue
+        code = ((code << 2) | base_code) & mask
+        valid += 1
+        if valid >= k:
+            positions = kmer_index[code]
+            if positions is not None:
+                ref_positions.update(positions)
+    max_intersection = len(ref_positions)
     if max_intersection > 0:
         max_consecutive, best_consecutive_end = longest_consecutive(ref_positions)
 
@@ -149,34 +203,56 @@ def find_best_match(query, mismatch_to_kmer, kmer_to_refs, k):
 
     return max_intersection, max_consecutive, best_consecutive_end
 
-def soft_processed(sequence, strand, cigar):
+def build_seed_table(kmer_index, k):
     """
-    根据 strand 和 cigar 信息提取指定长度的序列部分。
-    为direct RNA设置
-    参数:
-    - sequence (str): 原始的序列字符串。这个sequence已经被reverse处理过了，与正链一致，所以取序列的时候都从开头取起
-    - strand (str): 链方向，"+" 或 "-"。
-    - cigar (list of tuples): CIGAR 信息，表示为列表的元组 (operation, length)。
-                              例如 [(4, 5), (0, 50)] 表示 5 bp 的 soft clipping，接着是 50 bp 的匹配。
-    返回:
-    - str: 根据条件截取后的序列。再多加两个碱基在后面
+    prefilter seeds: every SL k-mer and its 1-mismatch neighbours, as a 2-bit code lookup table
     """
-    if not cigar:
-        return ""  # Return empty string if no CIGAR info
+    seed_table = bytearray(4 ** k)
+    for ref_kmer_index in kmer_index.values():
+        for code, positions in enumerate(ref_kmer_index):
+            if positions is not None:
+                seed_table[code] = 1
+    return seed_table
+
+def count_seed_hits(query, seed_table, k):
+    """
+    number of query k-mers found in the seed table
+    """
+    hits = 0
+    mask = (1 << (2 * k)) - 1
+    code = 0
+    valid = 0
+    for base in query:
+        base_code = KMER_BASE_CODE.get(base)
+        if base_code is None:
+            code = 0
+            valid = 0
+            continue
+        code = ((code << 2) | base_code) & mask
+        valid += 1
+        if valid >= k:
+            hits += seed_table[code]
+    return hits
+
+# IUPAC complement, the same pairs as Bio.Seq reverse_complement
+COMPLEMENT_TABLE = str.maketrans('ACGTMRWSYKVHDBNacgtmrwsykvhdbn', 'TGCAKYWSRMBDHVNtgcakywsrmbdhvn')
 
+def reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT_TABLE)[::-1]
+
+def clip_window(sequence, strand, cigar):
+    """
+    5′ soft clip of a direct RNA read plus the first 2 aligned bases, on the RNA strand (None if there is no clip)
+    for "-" reads only the clip (+2 bases) at the end of the stored sequence is sliced and reverse complemented
+    """
+    if not cigar:
+        return ""
     if strand == "+":
         if cigar[0][0] == 4:
-            soft_clip_length = cigar[0][1]
-            # 返回从序列开头截取 soft_clip_length 长度的序列部分
-            return sequence[:soft_clip_length + 2]  #
-    elif strand == "-":
-        if cigar[-1][0] == 4:
-            soft_clip_length = cigar[-1][1]
-            # 返回从序列开头截取 soft_clip_length 长度的序列部分
-            return sequence[:soft_clip_length + 2]  #
-    else:
-        # 不符合条件时，返回原始序列
-        return ""
+            return sequence[:cigar[0][1] + 2]
+    elif cigar[-1][0] == 4:
+        return reverse_complement(sequence[-(cigar[-1][1] + 2):])
+    return None
 
 def soft_extract(sequence, cigar):
     """
@@ -200,28 +276,10 @@ def soft_extract(sequence, cigar):
         soft_clip_length = cigar[-1][1]
         # 返回从序列尾部截取 soft_clip_length 长度的序列部分
         seq_3 = sequence[-(soft_clip_length + 2):]  #
-        query_re_3 = str(Seq(seq_3).reverse_complement())
+        query_re_3 = reverse_complement(seq_3)
 
     return seq_5, query_re_3
 
-def ssw_wrapper(seq1, seq2, match=1, mismatch=1, gap_open=1, gap_extend=1):
-    """
-    parameter are write inside the function
-    seq1 is ref and seq2 is query
-    # todo : leave a api to change matrix
-    """
-
-    ref_seq = str(seq1)
-    read_seq = str(seq2)
-    # reduce the gap open score from 3 to 1 for nanopore reads
-    aligner = Aligner(ref_seq,
-                      match, mismatch, gap_open, gap_extend,
-                      report_cigar=True, )
-
-    aln = aligner.align(read_seq)  # min_score=20, min_len=10)
-
-    return aln
-
 def consensus(ref, query, cigar_string, ref_shift=0, query_shift = 0):
     """
     to get a concensus sequence as the longest cons of both sequence,
@@ -243,6 +301,7 @@ def consensus(ref, query, cigar_string, ref_shift=0, query_shift = 0):
 
     query_pos = query_shift
     ref_pos = ref_shift
+    r_s = None
 
     cigar_pattern = pattern.findall(cigar_string)
     for i, (length, code) in enumerate(cigar_pattern):
@@ -252,14 +311,25 @@ def consensus(ref, query, cigar_string, ref_shift=0, query_shift = 0):
 
         length = int(length)
 
-        if code == "M":
+        if code == "M" and ref_pos + length <= len(ref):
+            # whole match run at once
+            query_run = query[query_pos:query_pos + length].upper()
+            ref_run = ref[ref_pos:ref_pos + length].upper()
+            query_out.append(query_run)
+            ref_out.append(ref_run)
+            cons.append(''.join([q_s if q_s == r_s else "m" for q_s, r_s in zip(query_run, ref_run)]))
+            r_s = ref_run[-1]
+            ref_pos += length
+            query_pos += length
+
+        elif code == "M":
             for i in range(length):
                 q_s = query[query_pos].upper()
-                try:
+                if ref_pos < len(ref):
                     r_s = ref[ref_pos].upper()
-                except IndexError as e:
-                    print
-                    "indexerror", ref_pos
+                elif r_s is None:
+                    raise ValueError('CIGAR ' + cigar_string + ' runs past the reference ' + repr(ref))
+                # else the reference was sliced one base short (cDNA, see sl_consensus): compare with its last base
 
                 query_out.append(q_s)
                 ref_out.append(r_s)
@@ -321,12 +391,12 @@ def ref_score_calculate(sw_score, max_intersection, max_consecutive):
     final_score = max(score, 0)
     return final_score
 
-def length_index(SL, ref_seq, kmer, mismatch_to_kmer, random_seq_len, k):
+def length_index(aligner_pool, SL, ref_seq, kmer_index, random_seq_len, k):
     dict = {}
 
     for i in range(k, len(ref_seq) + 1):
         ref_seq_s = ref_seq[-i:]
-        sw_aln = ssw_wrapper(ref_seq, ref_seq_s)  # score>10,
+        sw_aln = aligner_pool.align(SL, ref_seq_s)  # score>10,
         sw_score = sw_aln.score
         # ref_start = sw_aln.ref_begin
         # ref_end = sw_aln.ref_end
@@ -339,9 +409,7 @@ def length_index(SL, ref_seq, kmer, mismatch_to_kmer, random_seq_len, k):
         seq_s_length = len(corrected_sequence_sw)
         ref_length = len(ref_seq)
         # seq_length = read_end - read_start
-        kmer_to_refs = kmer[SL]
-        max_intersection, max_consecutive, best_end = find_best_match(corrected_sequence_sw, mismatch_to_kmer,
-                                                                      kmer_to_refs, k)
+        max_intersection, max_consecutive, best_end = find_best_match(corrected_sequence_sw, kmer_index[SL], k)
         final_score = ref_score_calculate(sw_score, max_intersection, max_consecutive)
         dict[i] = final_score
 
@@ -356,114 +424,341 @@ def final_score_process(final_score, ref_length, seq_s_length, length_score):
         # final_score_normalized = 100 * (final_score / (seq_s_length / ref_length * length_score[ref_length]))
     return SL_score # final_score_normalized
 
-def random_score(random_sequences_dict, random_kmer, random_mismatch_to_kmer,length_scores, random_seq_len, corrected_sequence, k):
+def random_score(alignments, random_sequences_dict, random_kmer_index, length_scores, random_seq_len, corrected_sequence, k,
+                 mode, profiler=None):
     random_sw_score_max = 0
     random_final_score_max = 0
     random_SL_score_max = 0
     length_score = length_scores[random_seq_len]
     for key, random_seq in random_sequences_dict.items():
-        random_length_score = length_score
-        random_aln_sw = ssw_wrapper(random_seq, corrected_sequence)
-        random_sw_score = random_aln_sw.score
-        random_read_start = random_aln_sw.query_begin
-        random_read_end = random_aln_sw.query_end + 1
-        corrected_sequence_sw = corrected_sequence[random_read_start:random_read_end]
-        seq_s_length = len(corrected_sequence_sw)
-
-        if seq_s_length >= 5:
-            random_ref_end = random_aln_sw.ref_end + 1
-            random_ref_length = len(random_seq)
-            kmer_to_refs = random_kmer[key]
-            max_intersection, max_consecutive, best_end = find_best_match(corrected_sequence_sw,
-                                                                          random_mismatch_to_kmer,
-                                                                          kmer_to_refs, k)
-            if mode == 'RNA':
-                random_final_score = drs_score_calculate(random_sw_score, max_intersection, max_consecutive, random_ref_end,
-                                                 random_ref_length, random_seq_len, random_read_start, len(corrected_sequence))
-            else:
-                random_final_score = cdna_score_calculate(random_sw_score, max_intersection, max_consecutive, random_ref_end,
-                                                 random_ref_length, random_seq_len, random_read_end, len(corrected_sequence))
-            random_SL_score = final_score_process(random_final_score, random_ref_length,
-                                                  seq_s_length, random_length_score)
-            if random_SL_score > random_SL_score_max:
-                random_sw_score_max = random_sw_score
-                random_final_score_max = random_final_score
-                random_SL_score_max = random_SL_score
+        scores = random_control_score(alignments[random_ref_id(key)], random_seq, random_kmer_index[key],
+                                      length_score, random_seq_len, corrected_sequence, k, mode, profiler)
+        if scores is not None and scores[2] > random_SL_score_max:
+            random_sw_score_max, random_final_score_max, random_SL_score_max = scores
 
     return random_sw_score_max, random_final_score_max, random_SL_score_max
 
-def update(*a):
-    if a[0] is not None:
-        outfile.write(a[0])
-    pbar.update(1)
-
-def drs_calculation_per_process(item,sl_dict,length_scores,random_sequences_dict,random_seq_len,random_kmer,
-                                random_mismatch_to_kmer,k,kmer,mismatch_to_kmer):
-    query_name = item[0]
-    full_query_sequence = item[1]
-    strand = item[2]
-    if strand == '-':
-        query_seq = str(Seq(full_query_sequence).reverse_complement())  # 序列映射到负链，需要反向互补处理
+def random_control_score(random_aln_sw, random_seq, random_kmer_index, random_length_score, random_seq_len,
+                         corrected_sequence, k, mode, profiler=None):
+    """
+    (sw_score, final_score, SL_score) of the clip against one random reference, None if the aligned part is too short
+    """
+    random_sw_score = random_aln_sw.score
+    random_read_start = random_aln_sw.query_begin
+    random_read_end = random_aln_sw.query_end + 1
+    corrected_sequence_sw = corrected_sequence[random_read_start:random_read_end]
+    seq_s_length = len(corrected_sequence_sw)
+    if seq_s_length < 5:
+        return None
+    random_ref_end = random_aln_sw.ref_end + 1
+    random_ref_length = len(random_seq)
+    best_match = profiled(profiler, 'find_best_match', find_best_match)
+    max_intersection, max_consecutive, best_end = best_match(corrected_sequence_sw, random_kmer_index, k)
+    if mode == 'RNA':
+        random_final_score = drs_score_calculate(random_sw_score, max_intersection, max_consecutive, random_ref_end,
+                                         random_ref_length, random_seq_len, random_read_start, len(corrected_sequence))
     else:
-        query_seq = full_query_sequence  # 序列映射到正链，直接使用
+        random_final_score = cdna_score_calculate(random_sw_score, max_intersection, max_consecutive, random_ref_end,
+                                         random_ref_length, random_seq_len, random_read_end, len(corrected_sequence))
+    random_SL_score = final_score_process(random_final_score, random_ref_length, seq_s_length, random_length_score)
+    return random_sw_score, random_final_score, random_SL_score
 
-    corrected_sequence = soft_processed(query_seq, strand, item[3])
-    aligned_len = item[4]
+SL_RECORD_COLUMNS = ['read_end', 'query_length', 'consensus', 'random_sw_score', 'random_final_score',
+                     'random_SL_score', 'sw_score', 'final_score', 'SL_score']
 
-    if corrected_sequence is not None:
-        soft_length = len(corrected_sequence)
-        mes = query_name + '\t' + strand + '\t' + str(soft_length) + '\t' + str(aligned_len) + '\t'  # with soft_processed
+def select_sl(SL_sw_dict):
+    """
+    pick the SL with the highest SL_score above its random control
+    Returns (SL, SL_type):
+    - SL_type is the SL name, or SL + '_unknown' when several SL share the highest score
+    - when no SL beats the random control, the SL with the highest SL_score is returned with SL_type 'random'
+    the first SL in reference order wins every tie, as with the former per-read DataFrame
+    """
+    best_SL = None
+    best_score = None
+    n_best = 0
+    for SL, record in SL_sw_dict.items():
+        SL_score = record['SL_score']
+        if SL_score > record['random_SL_score']:
+            if best_SL is None or SL_score > best_score:
+                best_SL = SL
+                best_score = SL_score
+                n_best = 1
+            elif SL_score == best_score:
+                n_best += 1
+    if best_SL is not None:
+        if n_best > 1:
+            return best_SL, best_SL + '_unknown'
+        return best_SL, best_SL
+
+    random_SL = max(SL_sw_dict, key=lambda SL: SL_sw_dict[SL]['SL_score'])
+    return random_SL, 'random'
+
+def format_sl_record(SL_sw_dict, SL):
+    """
+    tab-joined result columns of one SL.
+    numbers follow the column types the former per-read DataFrame inferred over all SL:
+    a column holding any float, or numbers mixed with None, is printed as float
+    """
+    values = []
+    for column in SL_RECORD_COLUMNS:
+        value = SL_sw_dict[SL][column]
+        column_values = [record[column] for record in SL_sw_dict.values()]
+        numbers = [v for v in column_values if isinstance(v, (int, float))]
+        as_float = len(numbers) > 0 and not any(isinstance(v, str) for v in column_values) and \
+            (any(isinstance(v, float) for v in numbers) or len(numbers) < len(column_values))
+        if as_float:
+            values.append('nan' if value is None else str(float(value)))
+        else:
+            values.append(str(value))
+    return '\t'.join(values)
+
+def random_ref_id(key):
+    return ('random', key)
+
+def build_aligner_pool(sl_dict, random_sequences_dict):
+    """
+    SL and random reference aligners, built once per worker (make_worker_state) and reused for every read
+    """
+    references = dict(sl_dict)
+    references.update({random_ref_id(key): seq for key, seq in random_sequences_dict.items()})
+    return AlignerPool(references, **SW_SCORING)
+
+KMER_SIZE = 5
+RANDOM_SEED = 826
+RANDOM_SEQUENCES = 10
+SW_SCORING = {'match': 1, 'mismatch': 1, 'gap_open': 1, 'gap_extend': 1}
+
+def index_parameters(k):
+    """
+    everything besides the SL references that build_detector depends on, part of the SL index key
+    """
+    return {'k': k, 'random_seed': RANDOM_SEED, 'random_sequences': RANDOM_SEQUENCES, 'sw_scoring': SW_SCORING}
+
+def build_detector(sl_dict, k):
+    """
+    derive the detector state from the SL references: random controls, k-mer indexes and length scores
+    saved by SL_detect.py index, so a run can load it with --index instead
+    """
+    # 生成10个长度为SL1长度的碱基的随机序列
+    ref_lengths = [len(key) for key in sl_dict.values()]
+    random_seq_len = round(sum(ref_lengths) / len(ref_lengths))
+    random.seed(RANDOM_SEED)
+    random_sequences_dict = {}
+    for i in range(RANDOM_SEQUENCES):
+        random_sequence = ''.join([random.choice('AGTC') for _ in range(random_seq_len)])
+        random_sequences_dict[i] = random_sequence
+
+    kmer = extract_kmers(sl_dict, k)
+    mismatch_to_kmer = build_mismatch_index(sl_dict, k)
+    random_kmer = extract_kmers(random_sequences_dict, k)
+    random_mismatch_to_kmer = build_mismatch_index(random_sequences_dict, k)
+    kmer_index = build_kmer_indexes(kmer, mismatch_to_kmer, k)
+    random_kmer_index = build_kmer_indexes(random_kmer, random_mismatch_to_kmer, k)
+
+    length_scores = {}
+
+    aligner_pool = build_aligner_pool(sl_dict, random_sequences_dict)
+    SL_ref_length = get_sequences_by_length(sl_dict)
+    for SL, info in SL_ref_length.items():
+        length_score = length_index(aligner_pool, SL, info['sequence'], kmer_index, random_seq_len, k)
+        length_scores[len(info['sequence'])] = length_score
+    return {'sl_dict': sl_dict, 'length_scores': length_scores,
+            'random_sequences_dict': random_sequences_dict, 'random_seq_len': random_seq_len,
+            'random_kmer_index': random_kmer_index, 'k': k, 'kmer_index': kmer_index}
+
+NULL_SEED = 2024
+NULL_REFERENCES = 50
+NULL_CLIPS = 10
+NULL_GC_BINS = 5
+# clip length bins: every length up to 32, then 25% wider each, longer clips use the last bin
+NULL_LENGTHS = list(range(1, 33)) + sorted(set(int(32 * 1.25 ** i) for i in range(1, 20)))
+
+def null_table_parameters():
+    return {'seed': NULL_SEED, 'references': NULL_REFERENCES, 'clips': NULL_CLIPS, 'gc_bins': NULL_GC_BINS,
+            'lengths': NULL_LENGTHS, 'random_sequences': RANDOM_SEQUENCES}
+
+def null_bin(clip):
+    """
+    (length bin, GC bin) of a clip in the null table
+    """
+    length_bin = max(bisect_right(NULL_LENGTHS, len(clip)) - 1, 0)
+    gc = (clip.count('G') + clip.count('C')) / max(len(clip), 1)
+    return length_bin, min(int(gc * NULL_GC_BINS), NULL_GC_BINS - 1)
+
+def null_score(null_table, mode, clip):
+    """
+    expected random control (sw_score, final_score, SL_score) of a clip, looked up in build_null_table
+    """
+    length_bin, gc_bin = null_bin(clip)
+    return tuple(null_table[mode][length_bin][gc_bin])
+
+def in_null_sample(clip, percent):
+    """
+    clips validated against the random alignments, chosen by a hash of the clip so repeated clips agree
+    """
+    if percent <= 0 or not clip:
+        return False
+    return zlib.crc32(clip.encode()) % 10000 < percent * 100
+
+def build_null_table(detector):
+    """
+    empirical null model of the random control: for every clip length and GC bin, random clips are aligned to
+    NULL_REFERENCES random references and the best of every group of RANDOM_SEQUENCES references is kept,
+    as random_score does; the table holds the mean of these maxima for both modes
+    """
+    k = detector['k']
+    random_seq_len = detector['random_seq_len']
+    length_score = detector['length_scores'][random_seq_len]
+    rng = random.Random(NULL_SEED)
+    references = {}
+    for i in range(NULL_REFERENCES):
+        references[i] = ''.join([rng.choice('AGTC') for _ in range(random_seq_len)])
+    kmer_index = build_kmer_indexes(extract_kmers(references, k), build_mismatch_index(references, k), k)
+    aligner_pool = AlignerPool(references, **SW_SCORING)
+    groups = [list(references)[i:i + RANDOM_SEQUENCES] for i in range(0, NULL_REFERENCES, RANDOM_SEQUENCES)]
+    table = {'parameters': null_table_parameters(), 'RNA': [], 'cDNA': []}
+    for length_bin, min_length in enumerate(NULL_LENGTHS):
+        if length_bin + 1 < len(NULL_LENGTHS):
+            max_length = NULL_LENGTHS[length_bin + 1] - 1
+        else:
+            max_length = min_length
+        rows = {'RNA': [], 'cDNA': []}
+        for gc_bin in range(NULL_GC_BINS):
+            gc = (gc_bin + 0.5) / NULL_GC_BINS
+            sums = {'RNA': [0, 0, 0], 'cDNA': [0, 0, 0]}
+            for _ in range(NULL_CLIPS):
+                clip = ''.join([rng.choice('GC') if rng.random() < gc else rng.choice('AT')
+                                for _ in range(rng.randint(min_length, max_length))])
+                alignments = aligner_pool.align_all(clip, report_cigar=False)
+                for mode_name in sums:
+                    for group in groups:
+                        best = (0, 0, 0)
+                        for key in group:
+                            scores = random_control_score(alignments[key], references[key], kmer_index[key],
+                                                          length_score, random_seq_len, clip, k, mode_name)
+                            if scores is not None and scores[2] > best[2]:
+                                best = scores
+                        for i in range(3):
+                            sums[mode_name][i] += best[i]
+            samples = NULL_CLIPS * len(groups)
+            for mode_name, values in sums.items():
+                # the random sw score column stays an integer
+                rows[mode_name].append([round(values[0] / samples), values[1] / samples, values[2] / samples])
+        for mode_name in rows:
+            table[mode_name].append(rows[mode_name])
+    return table
+
+RESULT_HEADER = "query_name\tstrand\tsoft_length\taligned_length\tread_end\tquery_length\tconsensus\trandom_sw_score\trandom_final_score\trandom_SL_score\tsw_score\tfinal_score\tSL_score\tSL_type\n"
+NA_SL_RECORD = '\t'.join(['NA'] * 9)
+# python type of every result column, as detector.parse_result reads the table
+RESULT_TYPES = [int if column in INT_COLUMNS else float if column in SCORE_COLUMNS else None
+                for column in RESULT_HEADER.rstrip('\n').split('\t')]
+
+def report_run_stats(run_stats):
+    print('Random control alignments skipped (shared by all SL references): '
+          + str(run_stats['random_alignments_skipped']))
+    if run_stats['prefilter_checked'] > 0:
+        rejected = run_stats['prefilter_rejected']
+        print('Prefilter rejected ' + str(rejected) + ' of ' + str(run_stats['prefilter_checked'])
+              + ' reads (' + str(round(100 * rejected / run_stats['prefilter_checked'], 2)) + '%)')
+        if run_stats['prefilter_validated'] > 0:
+            print('Prefilter validation: ' + str(run_stats['prefilter_changed']) + ' of ' + str(rejected)
+                  + ' rejected reads would have changed their call')
+    if run_stats['clip_truncated'] > 0:
+        print('Long clips truncated to --max-clip: ' + str(run_stats['clip_truncated']) + ' clips, '
+              + str(run_stats['clip_bases_dropped']) + ' bases not searched')
+    if run_stats['null_validated'] > 0:
+        print('Null table validation: ' + str(run_stats['null_changed']) + ' of ' + str(run_stats['null_validated'])
+              + ' sampled clips change their call with the random alignments')
+    lookups = run_stats['clip_cache_hits'] + run_stats['clip_cache_misses']
+    if lookups > 0:
+        print('Clip cache: ' + str(run_stats['clip_cache_hits']) + ' hits, ' + str(run_stats['clip_cache_misses'])
+              + ' misses (' + str(round(100 * run_stats['clip_cache_hits'] / lookups, 2)) + '% hit rate)')
+
+def sl_consensus(aligner_pool, SL, SEQ, corrected_sequence, mode, profiler=None):
+    """
+    consensus column of the selected SL, the only alignment of the clip that needs a traceback
+    """
+    sw_aln = aligner_pool.align(SL, corrected_sequence)
+    ref_start = sw_aln.ref_begin
+    if mode == 'RNA':
+        ref_end = sw_aln.ref_end + 1
+    else:
+        ref_end = sw_aln.ref_end  # cDNA has always scored with the inclusive end
+    corrected_sequence_sw = corrected_sequence[sw_aln.query_begin:sw_aln.query_end + 1]
+    return profiled(profiler, 'consensus', consensus)(SEQ[ref_start:ref_end], corrected_sequence_sw,
+                                                      sw_aln.cigar_string, 0)
+
+def evaluate_clip(corrected_sequence, mode, aligner_pool, sl_dict, length_scores, random_sequences_dict,
+                  random_seq_len, random_kmer_index, k, kmer_index, null_table=None, null_validate=0, profiler=None):
+    """
+    score one clip against every SL reference and select the SL
+    nothing here depends on the read beyond the clip, so reads sharing a clip share the result
+    aligner_pool: build_aligner_pool of the same references, kept in the worker state
+    null_table: take the random control from build_null_table instead of aligning the clip to the random references,
+    null_validate: percentage of clips also scored with the random alignments to count changed calls
+    profiler: StageProfiler of the worker (--profile), the scoring stages are timed here
+    Returns (clip_result, stats); clip_result holds soft_length, the formatted SL columns (record), SL_type,
+    the best SL_score above its random control (sl_max, 0 if none) and the best SL_score overall (sl_max_f)
+    """
+    soft_length = len(corrected_sequence)
+    best_match = profiled(profiler, 'find_best_match', find_best_match)
+    select = profiled(profiler, 'winner_selection', select_sl)
+    format_record = profiled(profiler, 'winner_selection', format_sl_record)
+    validate = null_table is not None and in_null_sample(corrected_sequence, null_validate)
+    if null_table is None or validate:
+        # one sweep of the clip over every SL and random reference
+        alignments = aligner_pool.align_all(corrected_sequence, report_cigar=False)
+        # random control only depends on the clip, so it is shared by every SL reference
+        random_sw_score_max, random_final_score_max, random_SL_score_max = random_score(alignments,
+                                                                                        random_sequences_dict,
+                                                                                        random_kmer_index,
+                                                                                        length_scores, random_seq_len,
+                                                                                        corrected_sequence, k, mode,
+                                                                                        profiler)
+        stats = {'random_alignments_skipped': (len(sl_dict) - 1) * len(random_sequences_dict)}
     else:
-        soft_length = 0
-        mes = query_name + '\t' + strand + '\t' + 'NA' + '\t' + str(aligned_len) + '\t'  # with soft_processed
-
-    if soft_length < k:  # 太短了就不要了
-        SL_sw_dict = {'read_end': 'NA', 'query_length': 'NA',
-                      'consensus': 'NA', 'random_sw_score': 'NA',
-                      'random_final_score': 'NA', 'random_SL_score': 'NA',
-                      'sw_score': 'NA', 'final_score': 'NA',
-                      'SL_score': 'NA'}
-        mes = mes + '\t'.join([str(value) for value in SL_sw_dict.values()]) + '\t' + 'random' + "\n"
-        return mes
+        alignments = aligner_pool.align_all(corrected_sequence, list(sl_dict), report_cigar=False)
+        stats = {'random_alignments_skipped': len(sl_dict) * len(random_sequences_dict)}
+    if null_table is not None:
+        exact_random = (random_sw_score_max, random_final_score_max, random_SL_score_max) if validate else None
+        random_sw_score_max, random_final_score_max, random_SL_score_max = null_score(null_table, mode,
+                                                                                      corrected_sequence)
 
     ### use SL1 seq for SW check
     SL_sw_dict = {}
     for SL, SEQ in sl_dict.items():
         length_score = length_scores[len(SEQ)]
         # corrected_sequence = 'CAAG'
-        sw_aln = ssw_wrapper(SEQ, corrected_sequence)  # score>10,
+        sw_aln = alignments[SL]  # score>10,
         sw_score = sw_aln.score
         ref_start = sw_aln.ref_begin
-        ref_end = sw_aln.ref_end + 1
+        if mode == 'RNA':
+            ref_end = sw_aln.ref_end + 1
+        else:
+            ref_end = sw_aln.ref_end  # cDNA has always scored with the inclusive end
         read_start = sw_aln.query_begin
         read_end = sw_aln.query_end + 1
-        sw_cigar = sw_aln.cigar_string
 
         corrected_sequence_sw = corrected_sequence[read_start:read_end]
 
         seq_s_length = len(corrected_sequence_sw)
-        random_sw_score_max, random_final_score_max, random_SL_score_max = random_score(random_sequences_dict,
-                                                                                        random_kmer,
-                                                                                        random_mismatch_to_kmer,
-                                                                                        length_scores, random_seq_len,
-                                                                                        corrected_sequence, k)
         if seq_s_length >= k:
-            sw_ref = SEQ[ref_start:ref_end]
-
-            # print("\n".join(consensus(corrected_sequence_sw, sw_ref, sw_cigar, 0)))
-            # last_three_chars = corrected_sequence_sw[-3:]
-            con_seq = consensus(sw_ref, corrected_sequence_sw, sw_cigar, 0)
             ref_length = len(SEQ)
-            kmer_to_refs = kmer[SL]
-            max_intersection, max_consecutive, best_end = find_best_match(corrected_sequence_sw, mismatch_to_kmer,
-                                                                          kmer_to_refs, k)
-            final_score = drs_score_calculate(sw_score, max_intersection, max_consecutive, ref_end, ref_length,
-                                          random_seq_len, read_start, soft_length) # sw_score, max_intersection, max_consecutive, ref_end, ref_length, seq_start, seq_length, soft_length
+            max_intersection, max_consecutive, best_end = best_match(corrected_sequence_sw, kmer_index[SL], k)
+            if mode == 'RNA':
+                final_score = drs_score_calculate(sw_score, max_intersection, max_consecutive, ref_end, ref_length,
+                                              random_seq_len, read_start, soft_length) # sw_score, max_intersection, max_consecutive, ref_end, ref_length, seq_start, seq_length, soft_length
+            else:
+                final_score = cdna_score_calculate(sw_score, max_intersection, max_consecutive, ref_end, ref_length,
+                                              random_seq_len, read_end, soft_length)
             SL_score = final_score_process(final_score, ref_length, seq_s_length, length_score)
 
             SL_sw_dict[SL] = {'read_end': read_end,
                               'query_length': seq_s_length,
-                              'consensus': con_seq,
+                              # only the selected SL is printed, its consensus is filled in after select_sl
+                              'consensus': '',
                               'random_sw_score': random_sw_score_max,
                               'random_final_score': round(random_final_score_max, 2),
                               'random_SL_score': round(random_SL_score_max, 2),
@@ -483,164 +778,688 @@ def drs_calculation_per_process(item,sl_dict,length_scores,random_sequences_dict
                               'SL_score': 0
                               }
 
-    SL_sw_df = pd.DataFrame.from_dict(SL_sw_dict, orient='index')
-    SL_sw_df_s = SL_sw_df[SL_sw_df['SL_score'] > SL_sw_df['random_SL_score']]
-    sl_max = SL_sw_df_s['SL_score'].max()
-    # filtered_df = SL_sw_df_s[SL_sw_df_s['SL_score'] == sl_max]
-    filtered_df = SL_sw_df_s[SL_sw_df_s['SL_score'] == sl_max]
-
-    if len(filtered_df) > 1:
-        mes = mes + '\t'.join([str(value) for value in filtered_df.iloc[0]]) + '\t' + filtered_df.index[
-            0] + '_unknown' + "\n"
-    elif len(filtered_df) == 1:
-        mes = mes + '\t'.join([str(value) for value in filtered_df.iloc[0]]) + '\t' + filtered_df.index[0] + "\n"
+    SL, SL_type = select(SL_sw_dict)
+    if SL_sw_dict[SL]['query_length'] is not None:
+        SL_sw_dict[SL]['consensus'] = sl_consensus(aligner_pool, SL, sl_dict[SL], corrected_sequence, mode, profiler)
+    if validate:
+        exact_sw_dict = {}
+        for name, values in SL_sw_dict.items():
+            if values['query_length'] is not None:
+                values = dict(values, random_sw_score=exact_random[0], random_final_score=round(exact_random[1], 2),
+                              random_SL_score=round(exact_random[2], 2))
+            exact_sw_dict[name] = values
+        stats.update({'null_validated': 1, 'null_changed': int(select(exact_sw_dict)[1] != SL_type)})
+    if SL_type == 'random':
+        sl_max = 0
+    else:
+        sl_max = SL_sw_dict[SL]['SL_score']
+    clip_result = {
+        "soft_length": soft_length,
+        "sl_max": sl_max,
+        "sl_max_f": max(record['SL_score'] for record in SL_sw_dict.values()),
+        "record": format_record(SL_sw_dict, SL),
+        "values": [SL_sw_dict[SL][column] for column in SL_RECORD_COLUMNS],
+        "SL_type": SL_type
+    }
+    return clip_result, stats
+
+class ClipCache(object):
+    """
+    per-worker LRU cache of evaluate_clip results keyed by (mode, clip sequence)
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        clip_result = self.entries.get(key)
+        if clip_result is not None:
+            self.entries.move_to_end(key)
+        return clip_result
+
+    def put(self, key, clip_result):
+        self.entries[key] = clip_result
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+def cached_evaluate_clip(clip_cache, stats, corrected_sequence, mode, *args, **kwargs):
+    """
+    evaluate_clip through the worker cache (if any), counters are added to stats
+    """
+    # the cDNA path passes [] for a missing end, it is cheap and never cached
+    if clip_cache is None or not isinstance(corrected_sequence, str):
+        clip_result, clip_stats = evaluate_clip(corrected_sequence, mode, *args, **kwargs)
+    else:
+        key = (mode, corrected_sequence)
+        clip_result = clip_cache.get(key)
+        if clip_result is not None:
+            stats['clip_cache_hits'] = stats.get('clip_cache_hits', 0) + 1
+            return clip_result
+        stats['clip_cache_misses'] = stats.get('clip_cache_misses', 0) + 1
+        clip_result, clip_stats = evaluate_clip(corrected_sequence, mode, *args, **kwargs)
+        clip_cache.put(key, clip_result)
+    for name, value in clip_stats.items():
+        stats[name] = stats.get(name, 0) + value
+    return clip_result
+
+def cap_clip(clip, max_clip, stats):
+    """
+    keep the last max_clip bases of a long clip (0: no limit)
+    clips end at the alignment boundary, where the SL is spliced, so adapters and chimeric parts are dropped;
+    the positional terms of drs/cdna_score_calculate are then relative to the window
+    """
+    if max_clip <= 0 or len(clip) <= max_clip:
+        return clip
+    stats['clip_truncated'] = stats.get('clip_truncated', 0) + 1
+    stats['clip_bases_dropped'] = stats.get('clip_bases_dropped', 0) + len(clip) - max_clip
+    return clip[-max_clip:]
+
+def shift_read_end(record, offset):
+    """
+    read_end of a formatted SL record counted from the start of the whole clip,
+    when only its last bases (starting offset bases in, see cap_clip) were searched;
+    query_length is the length of the aligned part and does not depend on the window
+    """
+    if offset == 0:
+        return record
+    read_end, rest = record.split('\t', 1)
+    if '.' in read_end:
+        read_end = str(float(read_end) + offset)
     else:
-        filtered_df_s = SL_sw_df[SL_sw_df['SL_score'] == SL_sw_df['SL_score'].max()]
-        mes = mes + '\t'.join([str(value) for value in filtered_df_s.iloc[0]]) + '\t' + 'random' + "\n"
-    return mes
+        read_end = str(int(read_end) + offset)
+    return read_end + '\t' + rest
 
-def cdna_calculation_per_process(item,sl_dict,length_scores,random_sequences_dict,random_seq_len,random_kmer,
-                                 random_mismatch_to_kmer,k,kmer,mismatch_to_kmer):
+def result_row(query_name, strand, soft_length, aligned_len, clip_result=None, offset=0, as_values=False):
+    """
+    one row of the result table, clip_result None labels the read random without a SL record;
+    offset: start of the searched window in the clip (see shift_read_end)
+    as_values returns the typed column values (None for missing) instead of the tab-joined line, used by the Detector
+    """
+    if as_values:
+        if clip_result is None:
+            record, SL_type = [None] * len(SL_RECORD_COLUMNS), 'random'
+        else:
+            record, SL_type = list(clip_result['values']), clip_result['SL_type']
+            if record[0] is not None:
+                record[0] += offset
+        row = [query_name, strand, soft_length, aligned_len] + record + [SL_type]
+        return tuple(value if value is None or cast is None else cast(value) for cast, value in zip(RESULT_TYPES, row))
+    mes = query_name + '\t' + strand + '\t' + ('NA' if soft_length is None else str(soft_length)) + '\t' + \
+        str(aligned_len) + '\t'
+    if clip_result is None:
+        return mes + NA_SL_RECORD + '\t' + 'random' + "\n"
+    return mes + shift_read_end(clip_result['record'], offset) + '\t' + clip_result['SL_type'] + "\n"
+
+def drs_calculation_per_process(item,aligner_pool,sl_dict,length_scores,random_sequences_dict,random_seq_len,random_kmer_index,
+                                k,kmer_index,seed_table=None,min_seeds=1,prefilter_validate=False,
+                                clip_cache=None,null_table=None,null_validate=0,
+                                max_clip=0,profiler=None,as_values=False):
     query_name = item[0]
-    query_seq = item[1]
+    corrected_sequence = item[1]  # 5′ clip window, already on the RNA strand
     strand = item[2]
-    aligned_len = item[4]
-    seq_5, seq_3 = soft_extract(query_seq, item[3])
+    aligned_len = item[3]
+
+    if corrected_sequence is not None:
+        soft_length = len(corrected_sequence)
+    else:
+        soft_length = None
+
+    if soft_length is None or soft_length < k:  # 太短了就不要了
+        return result_row(query_name, strand, soft_length, aligned_len, as_values=as_values), {'short_clip_skipped': 1}
+
+    stats = {}
+    corrected_sequence = cap_clip(corrected_sequence, max_clip, stats)
+    rejected = False
+    if seed_table is not None:
+        # no SL seed in the clip, label it random without any alignment
+        rejected = count_seed_hits(corrected_sequence, seed_table, k) < min_seeds
+        stats.update({'prefilter_checked': 1, 'prefilter_rejected': int(rejected)})
+        if rejected and not prefilter_validate:
+            return result_row(query_name, strand, soft_length, aligned_len, as_values=as_values), stats
+
+    clip_result = cached_evaluate_clip(clip_cache, stats, corrected_sequence, 'RNA', aligner_pool, sl_dict,
+                                       length_scores, random_sequences_dict, random_seq_len, random_kmer_index, k,
+                                       kmer_index, null_table=null_table, null_validate=null_validate,
+                                       profiler=profiler)
+    if rejected:
+        stats.update({'prefilter_validated': 1, 'prefilter_changed': int(clip_result['SL_type'] != 'random')})
+    mes = result_row(query_name, strand, soft_length, aligned_len, clip_result,
+                     soft_length - len(corrected_sequence), as_values)
+    return mes, stats
+
+def evaluate_ends(ends, clip_cache, missing_end_cache, stats, *args, **kwargs):
+    """
+    evaluate_clip results of both cDNA ends [seq_5, seq_3]
+    a missing end ([]) scores the same for every read, with missing_end_cache (a dict kept by the worker)
+    it is evaluated once instead of once per read; identical ends are evaluated once
+    """
+    results = []
+    for corrected_sequence in ends:
+        if isinstance(corrected_sequence, str):
+            if results and corrected_sequence == ends[0]:
+                results.append(results[0])
+            else:
+                results.append(cached_evaluate_clip(clip_cache, stats, corrected_sequence, 'cDNA', *args, **kwargs))
+        elif missing_end_cache is None:
+            results.append(cached_evaluate_clip(clip_cache, stats, corrected_sequence, 'cDNA', *args, **kwargs))
+        else:
+            if 'result' not in missing_end_cache:
+                missing_end_cache['result'] = cached_evaluate_clip(None, stats, corrected_sequence, 'cDNA',
+                                                                   *args, **kwargs)
+            stats['missing_end_reused'] = stats.get('missing_end_reused', 0) + 1
+            results.append(missing_end_cache['result'])
+    return results
+
+def pick_end(results):
+    """
+    index of the cDNA end reported for the read
+    """
+    seq1, seq2 = results
+    # 情况 1: 至少有一个 sl_max > 0，选择 sl_max 较大的
+    if seq1["sl_max"] > 0 or seq2["sl_max"] > 0:
+        return 0 if seq1["sl_max"] > seq2["sl_max"] else 1
+    # 情况 2: 两个 sl_max <= 0，比较 sl_max_f，选择 sl_max_f 较大的
+    return 0 if seq1["sl_max_f"] >= seq2["sl_max_f"] else 1
+
+def cdna_calculation_per_process(item,aligner_pool,sl_dict,length_scores,random_sequences_dict,random_seq_len,random_kmer_index,
+                                 k,kmer_index,seed_table=None,min_seeds=1,prefilter_validate=False,
+                                 clip_cache=None,null_table=None,null_validate=0,
+                                 max_clip=0,missing_end_cache=None,profiler=None,as_values=False):
+    query_name = item[0]
+    seq_5, seq_3 = item[1]
+    strand = item[2]
+    aligned_len = item[3]
     candidate_seq = [seq_5, seq_3]
 
     if seq_5 is None and seq_3 is None:
-        mes = query_name + '\t' + strand + '\t' + 'NA' + str(aligned_len) + '\t'  # with soft_processed
-        SL_sw_dict = {'read_end': 'NA', 'query_length': 'NA',
-                      'consensus': 'NA', 'random_sw_score': 'NA',
-                      'random_final_score': 'NA', 'random_SL_score': 'NA',
-                      'sw_score': 'NA', 'final_score': 'NA',
-                      'SL_score': 'NA'}
-        mes = mes + '\t'.join([str(value) for value in SL_sw_dict.values()]) + '\t' + 'random' + "\n"
-        return mes
+        return result_row(query_name, strand, None, aligned_len, as_values=as_values), {}
     elif len(seq_5) < 5 and len(seq_3) < 5:
         soft_length = max(len(seq_5), len(seq_3))
-        mes = query_name + '\t' + strand + '\t' + str(soft_length) + str(aligned_len) + '\t'  # with soft_processed
-        SL_sw_dict = {'read_end': 'NA', 'query_length': 'NA',
-                      'consensus': 'NA', 'random_sw_score': 'NA',
-                      'random_final_score': 'NA', 'random_SL_score': 'NA',
-                      'sw_score': 'NA', 'final_score': 'NA',
-                      'SL_score': 'NA'}
-        mes = mes + '\t'.join([str(value) for value in SL_sw_dict.values()]) + '\t' + 'random' + "\n"
-        return mes
+        return result_row(query_name, strand, soft_length, aligned_len, as_values=as_values), {'short_clip_skipped': 1}
 
-    results = []
-    for corrected_sequence in candidate_seq:
-        soft_length = len(corrected_sequence)
-        ### use SL1 seq for SW check
-        SL_sw_dict = {}
-        for SL, SEQ in sl_dict.items():
-            length_score = length_scores[len(SEQ)]
-            # corrected_sequence = 'CAAG'
-            sw_aln = ssw_wrapper(SEQ, corrected_sequence)  # score>10,
-            sw_score = sw_aln.score
-            ref_start = sw_aln.ref_begin
-            ref_end = sw_aln.ref_end
-            read_start = sw_aln.query_begin
-            read_end = sw_aln.query_end + 1
-            sw_cigar = sw_aln.cigar_string
-
-            corrected_sequence_sw = corrected_sequence[read_start:read_end]
-
-            seq_s_length = len(corrected_sequence_sw)
-            random_sw_score_max, random_final_score_max, random_SL_score_max = random_score(random_sequences_dict,
-                                                                                            random_kmer,
-                                                                                            random_mismatch_to_kmer,
-                                                                                            length_scores,
-                                                                                            random_seq_len,
-                                                                                            corrected_sequence, k)
-            if seq_s_length >= k:
-                sw_ref = SEQ[ref_start:ref_end]
-
-                # print("\n".join(consensus(corrected_sequence_sw, sw_ref, sw_cigar, 0)))
-                # last_three_chars = corrected_sequence_sw[-3:]
-                con_seq = consensus(sw_ref, corrected_sequence_sw, sw_cigar, 0)
-                ref_length = len(SEQ)
-                kmer_to_refs = kmer[SL]
-                max_intersection, max_consecutive, best_end = find_best_match(corrected_sequence_sw, mismatch_to_kmer,
-                                                                              kmer_to_refs, k)
-                final_score = cdna_score_calculate(sw_score, max_intersection, max_consecutive, ref_end, ref_length,
-                                              random_seq_len, read_end, soft_length)  # sw_score, max_intersection, max_consecutive, ref_end, ref_length, seq_start, seq_length, soft_length
-                SL_score = final_score_process(final_score, ref_length, seq_s_length, length_score)
-
-                SL_sw_dict[SL] = {'read_end': read_end,
-                                  'query_length': seq_s_length,
-                                  'consensus': con_seq,
-                                  'random_sw_score': random_sw_score_max,
-                                  'random_final_score': round(random_final_score_max, 2),
-                                  'random_SL_score': round(random_SL_score_max, 2),
-                                  'sw_score': sw_score,
-                                  'final_score': round(final_score, 2),
-                                  'SL_score': round(SL_score, 2)
-                                  }
-            else:
-                SL_sw_dict[SL] = {'read_end': read_end,
-                                  'query_length': None,
-                                  'consensus': None,
-                                  'random_sw_score': 0,
-                                  'random_final_score': 0,
-                                  'random_SL_score': 0,
-                                  'sw_score': 0,
-                                  'final_score': 0,
-                                  'SL_score': 0
-                                  }
-
-        SL_sw_df = pd.DataFrame.from_dict(SL_sw_dict, orient='index')
-        SL_sw_df_s = SL_sw_df[SL_sw_df['SL_score'] > SL_sw_df['random_SL_score']]
-        sl_max = 0 if pd.isna(SL_sw_df_s['SL_score'].max()) else SL_sw_df_s['SL_score'].max()
-        sl_max_f = SL_sw_df['SL_score'].max()
-        filtered_df = SL_sw_df_s[SL_sw_df_s['SL_score'] == sl_max]
-        filtered_df_f = SL_sw_df[SL_sw_df['SL_score'] == sl_max_f]
-        results.append({
-            "soft_length": soft_length,
-            "sl_max": sl_max,
-            "sl_max_f": sl_max_f,
-            "filtered_df": filtered_df,
-            "filtered_df_f": filtered_df_f
-        })
-    best_filtered_df = []
-    best_filtered_df_f = []
-    if len(results) == 1:
-        # 只有一个非空序列，直接使用其 filtered_df
-        soft_length = results[0]['soft_length']
-        best_filtered_df = results[0]["filtered_df"]
-    elif len(results) == 2:
-        seq1, seq2 = results
-        # 情况 1: 至少有一个 sl_max > 0，选择 sl_max 较大的
-        if seq1["sl_max"] > 0 or seq2["sl_max"] > 0:
-            if seq1["sl_max"] > seq2["sl_max"]:
-                best_filtered_df = seq1["filtered_df"]
-                soft_length = seq1["soft_length"]
-            else:
-                best_filtered_df = seq2["filtered_df"]
-                soft_length = seq2["soft_length"]
-                # 情况 2: 两个 sl_max <= 0，比较 sl_max_f，选择 sl_max_f 较小的
+    stats = {}
+    clip_lengths = [len(seq_5), len(seq_3)]
+    seq_5 = cap_clip(seq_5, max_clip, stats)
+    seq_3 = cap_clip(seq_3, max_clip, stats)
+    candidate_seq = [seq_5, seq_3]
+    rejected = False
+    if seed_table is not None:
+        # no SL seed at either end, label it random without any alignment
+        rejected = max(count_seed_hits(seq_5, seed_table, k), count_seed_hits(seq_3, seed_table, k)) < min_seeds
+        stats.update({'prefilter_checked': 1, 'prefilter_rejected': int(rejected)})
+        if rejected and not prefilter_validate:
+            return result_row(query_name, strand, max(clip_lengths), aligned_len, as_values=as_values), stats
+
+    results = evaluate_ends(candidate_seq, clip_cache, missing_end_cache, stats, aligner_pool, sl_dict, length_scores,
+                            random_sequences_dict, random_seq_len, random_kmer_index, k, kmer_index,
+                            null_table=null_table, null_validate=null_validate, profiler=profiler)
+    best_end = pick_end(results)
+    best = results[best_end]
+    if rejected:
+        stats.update({'prefilter_validated': 1, 'prefilter_changed': int(best["SL_type"] != 'random')})
+
+    # soft_length is the clip of the read, also when only its last max_clip bases were searched
+    mes = result_row(query_name, strand, clip_lengths[best_end], aligned_len, best,
+                     clip_lengths[best_end] - len(candidate_seq[best_end]), as_values)
+    return mes, stats
+
+PROFILE_STAGES = ['bam_reading', 'clip_extraction', 'sl_alignment', 'random_alignment', 'find_best_match',
+                  'consensus', 'winner_selection', 'output_writing']
+PROFILE_COUNTERS = ['sw_calls', 'dp_cells', 'short_clip_skipped']
+
+def profile_aligner_pool(profiler, aligner_pool, random_ref_ids):
+    """
+    time the SL and random parts of align_all separately and count SW calls / DP cells
+    """
+    align_all = aligner_pool.align_all
+    ref_lengths = {ref_id: len(seq) for ref_id, seq in aligner_pool.references.items()}
+
+    def timed_align_all(query, ref_ids=None, report_cigar=True):
+        if ref_ids is None:
+            ref_ids = list(aligner_pool.ref_arrays)
+        results = {}
+        for stage, stage_ids in [('sl_alignment', [ref_id for ref_id in ref_ids if ref_id not in random_ref_ids]),
+                                 ('random_alignment', [ref_id for ref_id in ref_ids if ref_id in random_ref_ids])]:
+            if stage_ids:
+                results.update(profiler.wrap(stage, align_all)(query, stage_ids, report_cigar))
+        profiler.count('sw_calls', len(ref_ids))
+        profiler.count('dp_cells', len(str(query)) * sum(ref_lengths[ref_id] for ref_id in ref_ids))
+        return results
+
+    aligner_pool.align_all = timed_align_all
+
+def profiled(profiler, stage, func):
+    """
+    func timed as stage by the worker profiler (--profile), func itself otherwise
+    """
+    if profiler is None:
+        return func
+    return profiler.wrap(stage, func)
+
+def load_detector(sl_dict, k, index=None, null_table=False):
+    """
+    detector state of the SL references (build_detector), read from the SL index file when given;
+    with null_table the state also holds the null score table, built here if the index has none
+    """
+    if index is not None:
+        detector = load_index(index, sl_checksum(sl_dict), index_parameters(k))
+    else:
+        detector = build_detector(sl_dict, k)
+    table = detector.pop('null_table', None)
+    if null_table:
+        if table is None or table['parameters'] != null_table_parameters():
+            print('Building the null score table, save it with SL_detect.py index --null-table to skip this step')
+            table = build_null_table(detector)
+        detector['null_table'] = table
+    return detector
+
+def detector_settings(detector, index=None, clip_cache=10000, max_clip=0, null_validate=0, prefilter=False,
+                      prefilter_min_seeds=1, prefilter_validate=False, profile=False, as_values=False):
+    """
+    the state sent once to every worker (see init_worker / make_worker_state)
+    """
+    if index is not None:
+        # the workers map the index file themselves instead of unpickling the tables
+        state = {'index_path': index}
+    else:
+        state = {name: value for name, value in detector.items() if name != 'null_table'}
+    state['clip_cache_size'] = clip_cache
+    state['max_clip'] = max_clip
+    if 'null_table' in detector:
+        state.update({'null_table': detector['null_table'], 'null_validate': null_validate})
+    if prefilter or prefilter_validate:
+        state.update({'seed_table': build_seed_table(detector['kmer_index'], detector['k']),
+                      'min_seeds': prefilter_min_seeds,
+                      'prefilter_validate': prefilter_validate})
+    if profile:
+        state['profile'] = True
+    if as_values:
+        state['as_values'] = True
+    return state
+
+def make_worker_state(state, mode):
+    """
+    keyword arguments of drs/cdna_calculation_per_process in one process: tables loaded, caches created
+    """
+    worker_state = dict(state)
+    if 'index_path' in worker_state:
+        index_state = load_index(worker_state.pop('index_path'))
+        # the null table is only used when the run asked for it, it is sent along then
+        index_state.pop('null_table', None)
+        worker_state.update(index_state)
+    clip_cache_size = worker_state.pop('clip_cache_size', 0)
+    if clip_cache_size > 0:
+        worker_state['clip_cache'] = ClipCache(clip_cache_size)
+    if mode == 'cDNA':
+        worker_state['missing_end_cache'] = {}
+    worker_state['aligner_pool'] = build_aligner_pool(worker_state['sl_dict'], worker_state['random_sequences_dict'])
+    if worker_state.pop('profile', False):
+        # the stage times are handed over with every batch, see process_batch
+        worker_state['profiler'] = StageProfiler()
+        random_ref_ids = set(random_ref_id(key) for key in worker_state['random_sequences_dict'])
+        profile_aligner_pool(worker_state['profiler'], worker_state['aligner_pool'], random_ref_ids)
+    return worker_state
+
+def score_batch(batch, mode, worker_state):
+    """
+    score a batch of reads, return the joined rows, the merged counters and the batch size
+    (a list of typed rows when the state asks for as_values, see result_row)
+    """
+    if mode == 'RNA':
+        calculation = drs_calculation_per_process
+    else:
+        calculation = cdna_calculation_per_process
+    messages = []
+    stats = Counter()
+    batch_size = 0
+    for item in batch:
+        mes, read_stats = calculation(item, **worker_state)
+        messages.append(mes)
+        stats.update(read_stats)
+        batch_size += 1
+    if worker_state.get('as_values'):
+        return messages, stats, batch_size
+    return ''.join(messages), stats, batch_size
+
+# per-process state of the pool workers, set by init_worker
+worker_state = None
+worker_mode = None
+
+def init_worker(state, mode):
+    """
+    pool initializer, the shared detector state is pickled once per worker instead of once per read
+    """
+    global worker_state, worker_mode
+    worker_state = make_worker_state(state, mode)
+    worker_mode = mode
+
+def process_batch(batch):
+    """
+    score a batch of reads inside a worker, same return value as score_batch
+    """
+    rows, stats, batch_size = score_batch(batch, worker_mode, worker_state)
+    if 'profiler' in worker_state:
+        stats.update(worker_state['profiler'].take())
+    return rows, stats, batch_size
+
+worker_bam_files = {}
+
+def process_region(region):
+    """
+    read and score one region inside a worker, each worker keeps its own handle on the BAM file
+    region: (bam_path, contig, start, end, shard), shard is a read-name shard (see in_shard) or None
+    same return value as process_batch
+    """
+    bam_path, contig, start, end, shard = region
+    if bam_path not in worker_bam_files:
+        worker_bam_files[bam_path] = pysam.AlignmentFile(bam_path, 'rb')
+    reads = region_reads(worker_bam_files[bam_path], contig, start, end)
+    make_item = read_item
+    profiler = worker_state.get('profiler')
+    if profiler is not None:
+        reads = profiler.timed_iter('bam_reading', reads)
+        make_item = profiler.wrap('clip_extraction', read_item)
+    return process_batch(make_item(read, worker_mode) for read in reads
+                         if shard is None or in_shard(read.query_name, shard))
+
+def process_sample_task(task):
+    """
+    --input with several BAM files: (sample index, by_region, batch or region) -> (sample index, rows, stats, size)
+    """
+    sample, by_region, work = task
+    if by_region:
+        return (sample,) + process_region(work)
+    return (sample,) + process_batch(work)
+
+def chunked(items, chunk_size):
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, chunk_size))
+        if not batch:
+            return
+        yield batch
+
+def read_item(read, mode):
+    """
+    turn an alignment into the item scored by the workers: [query_name, clip, strand, aligned_length]
+    clip is the 5′ window for RNA (clip_window) and the two end windows for cDNA (soft_extract),
+    so the full read sequence never leaves the reader
+    """
+    if read.is_reverse:
+        strand = '-'
+    else:
+        strand = '+'
+    if mode == 'RNA':
+        clip = clip_window(read.query_sequence, strand, read.cigartuples)
+    else:
+        clip = soft_extract(read.query_sequence, read.cigartuples)
+    return [read.query_name, clip, strand, read.query_alignment_length]
+
+STDIN = '-'
+
+def primary_reads(reads):
+    """
+    the alignments scored by SL_detect: mapped, neither secondary nor supplementary
+    """
+    return (read for read in reads if not (read.is_unmapped or read.is_supplementary or read.is_secondary))
+
+def read_bam(bam_path, mode, threads=1, regions=None, shard=None, profiler=None):
+    """
+    stream the primary alignments of a BAM file as worker items (see read_item)
+    bam_path '-' reads an unsorted SAM/BAM stream from stdin (e.g. straight from minimap2), read in file order
+    threads: extra threads used by pysam for BGZF decompression
+    regions: only read these regions (see plan_regions), shard: only keep reads of this read-name shard
+    profiler: StageProfiler timing the BAM decoding and the clip extraction (--profile)
+    """
+    make_item = read_item
+    if profiler is not None:
+        make_item = profiler.wrap('clip_extraction', read_item)
+    if bam_path == STDIN:
+        # htslib detects SAM or BAM from the first bytes of the stream
+        bam_file = pysam.AlignmentFile(bam_path, 'r', threads=threads)
+    else:
+        bam_file = pysam.AlignmentFile(bam_path, 'rb', threads=threads)
+    with bam_file:
+        if bam_path == STDIN:
+            # no index: every record in file order, unmapped ones included
+            reads = primary_reads(bam_file.fetch(until_eof=True))
+        elif regions is None:
+            reads = primary_reads(bam_file.fetch())
         else:
-            if seq1["sl_max_f"] >= seq2["sl_max_f"]:
-                best_filtered_df_f = seq1["filtered_df_f"]
-                soft_length = seq1["soft_length"]
-            else:
-                best_filtered_df_f = seq2["filtered_df_f"]
-                soft_length = seq2["soft_length"]
-
-    mes = query_name + '\t' + strand + '\t' + str(soft_length) + '\t' + str(aligned_len) + '\t'  # with soft_processed
-    if len(best_filtered_df) > 1:
-        mes = mes + '\t'.join([str(value) for value in best_filtered_df.iloc[0]]) + '\t' + best_filtered_df.index[
-                0] + '_unknown' + "\n"
-    elif len(best_filtered_df) == 1:
-        mes = mes + '\t'.join([str(value) for value in best_filtered_df.iloc[0]]) + '\t' + best_filtered_df.index[
-                0] + "\n"
+            reads = (read for _, contig, start, end in regions for read in region_reads(bam_file, contig, start, end))
+        if profiler is not None:
+            reads = profiler.timed_iter('bam_reading', reads)
+        for read in reads:
+            if shard is not None and not in_shard(read.query_name, shard):
+                continue
+            yield make_item(read, mode)
+
+def plan_regions(bam_path, n_regions):
+    """
+    split the genome into about n_regions regions holding a similar number of reads,
+    based on the .bai index statistics (reads are assumed evenly spread along a contig)
+    Returns [(bam_path, contig, start, end)] in genome order
+    """
+    with pysam.AlignmentFile(bam_path, 'rb') as bam_file:
+        lengths = dict(zip(bam_file.references, bam_file.lengths))
+        index_stats = bam_file.get_index_statistics()
+    total = sum(contig_stats.total for contig_stats in index_stats)
+    target = max(total / max(n_regions, 1), 1)
+    regions = []
+    for contig_stats in index_stats:
+        if contig_stats.total == 0:
+            continue
+        length = lengths[contig_stats.contig]
+        pieces = max(1, round(contig_stats.total / target))
+        step = -(-length // pieces)
+        for start in range(0, length, step):
+            regions.append((bam_path, contig_stats.contig, start, min(start + step, length)))
+    return regions
+
+def region_reads(bam_file, contig, start, end):
+    """
+    primary alignments starting inside [start, end),
+    a read spanning a region boundary is only reported by the region holding its start
+    """
+    for read in primary_reads(bam_file.fetch(contig, start, end)):
+        if read.reference_start < start:
+            continue
+        yield read
+
+def stream_batches(reads, chunk_size, max_queued):
+    """
+    producer thread cutting the read stream into batches,
+    at most max_queued batches wait in memory for the workers
+    """
+    return prefetch(chunked(reads, chunk_size), max_queued)
+
+def prefetch(batches, max_queued):
+    """
+    produce the batches in a background thread, at most max_queued of them wait in memory
+    the thread is stopped when the generator is closed before the end (or raises)
+    """
+    batch_queue = queue.Queue(maxsize=max_queued)
+    finished = object()
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for batch in batches:
+                if stop.is_set():
+                    break
+                batch_queue.put(batch)
+        except Exception as e:
+            batch_queue.put(e)
+        finally:
+            batch_queue.put(finished)
+
+    reader = threading.Thread(target=producer, daemon=True)
+    reader.start()
+    try:
+        while True:
+            batch = batch_queue.get()
+            if batch is finished:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+        # empty the queue so a producer blocked on put sees the stop
+        while reader.is_alive():
+            try:
+                batch_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        reader.join()
+
+def run_batches(pool, batches, max_in_flight, task=process_batch):
+    """
+    submit batches (or regions, with task=process_region) to the pool with at most max_in_flight unfinished tasks,
+    results are returned in submission order
+    when the generator is closed early the input is closed and the submitted tasks are waited for,
+    so the pool can be reused
+    """
+    pending = deque()
+    try:
+        for batch in batches:
+            pending.append(pool.apply_async(task, (batch,)))
+            while pending and (len(pending) >= max_in_flight or pending[0].ready()):
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        if hasattr(batches, 'close'):
+            batches.close()
+        for result in pending:
+            result.wait()
+
+REGIONS_PER_SHARD = 16
+
+def detection_parameters(args, k):
+    """
+    parameters that change the rows, partials can only be merged when they agree
+    """
+    if args.prefilter and not args.prefilter_validate:
+        prefilter_min_seeds = args.prefilter_min_seeds
     else:
-        mes = mes + '\t'.join([str(value) for value in best_filtered_df_f.iloc[0]]) + '\t' + 'random' + "\n"
+        prefilter_min_seeds = None
+    null_table = None
+    if args.null_table:
+        null_table = null_table_parameters()
+    return {'k': k, 'prefilter_min_seeds': prefilter_min_seeds, 'null_table': null_table, 'max_clip': args.max_clip}
 
-    return mes
+def table_path(args):
+    """
+    the sorted tsv, written next to the output when it is converted to parquet afterwards
+    """
+    if args.output_format == 'parquet':
+        return args.output + '.tsv.tmp'
+    return args.output
+
+def write_output_format(args):
+    if args.output_format == 'parquet':
+        if args.columns == 'minimal':
+            columns = MINIMAL_COLUMNS
+        else:
+            columns = None
+        tsv_to_parquet(table_path(args), args.output, columns)
+        os.remove(table_path(args))
+
+def check_output_args(parser, args):
+    if args.columns == 'minimal' and args.output_format != 'parquet':
+        parser.error('--columns minimal needs --output-format parquet')
+    if args.columns == 'minimal' and args.visualization:
+        parser.error('--visualization needs every column, use --columns all')
+    if args.output_format == 'parquet' and getattr(args, 'shard', None) is not None:
+        parser.error('shards are always written as tsv, pass --output-format to SL_detect.py merge')
+
+def check_run_args(parser, args):
+    if args.chunk_size < 1:
+        parser.error('--chunk-size must be at least 1, got ' + str(args.chunk_size))
+    if args.shard is not None:
+        try:
+            parse_shard(args.shard)
+        except ValueError as error:
+            parser.error('--shard: ' + str(error))
+    if args.max_clip != 0 and args.max_clip < KMER_SIZE:
+        # shorter windows are below the k-mer size and every read would be skipped as a short clip
+        parser.error('--max-clip must be 0 (whole clip) or at least ' + str(KMER_SIZE) + ', got ' + str(args.max_clip))
+    if args.null_table_validate and not args.null_table:
+        parser.error('--null-table-validate checks the --null-table calls, add --null-table')
+    if not 0 <= args.null_table_validate <= 100:
+        parser.error('--null-table-validate is a percentage between 0 and 100, got ' + str(args.null_table_validate))
+
+def sample_name(bam_path):
+    name = os.path.basename(bam_path)
+    for suffix in ['.bam', '.sam']:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def read_manifest(path):
+    """
+    one BAM file per line, optionally preceded by its sample name and a tab; empty lines and # comments are skipped
+    Returns [(sample, bam_path)]
+    """
+    samples = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) == 1:
+                samples.append((sample_name(fields[0]), fields[0]))
+            else:
+                samples.append((fields[0], fields[1]))
+    return samples
+
+def input_samples(args):
+    """
+    [(sample, bam_path)] of --input and --manifest, in the given order
+    """
+    samples = [(sample_name(bam_path), bam_path) for bam_path in args.input or []]
+    if args.manifest is not None:
+        samples.extend(read_manifest(args.manifest))
+    return samples
+
+def check_batch_args(parser, args, samples):
+    if not samples:
+        parser.error('give the BAM file with --input or several with --input/--manifest')
+    names = [sample for sample, _ in samples]
+    if len(set(names)) < len(names):
+        parser.error('sample names must be unique, name the BAM files in a --manifest (sample<TAB>bam)')
+    if STDIN in [bam_path for _, bam_path in samples]:
+        parser.error('--input - reads a single stream, it cannot be combined with other BAM files')
+    if args.shard is not None or args.checkpoint or args.resume or args.profile:
+        parser.error('--shard, --checkpoint, --resume and --profile work on a single BAM file')
+
+def check_input_args(parser, args):
+    if args.input != STDIN:
+        return
+    # a stream can neither be fetched by region nor read a second time
+    if args.by_region:
+        parser.error('--by-region needs an indexed BAM, not --input -')
+    if args.shard is not None:
+        parser.error('--shard needs the same BAM file on every node, not --input -')
+    if args.checkpoint or args.resume:
+        parser.error('--checkpoint/--resume need a BAM file that can be read again, not --input -')
+
+def run_fingerprint(args, sl_dict, k, regions):
+    """
+    everything that decides which rows each task produces, a checkpoint is only resumed when it matches
+    """
+    if args.by_region:
+        tasks = [[contig, start, end] for _, contig, start, end in regions]
+    else:
+        tasks = {'chunk_size': args.chunk_size}
+    return {'bam': file_fingerprint(args.input), 'sl_reference': sl_checksum(sl_dict), 'mode': args.mode,
+            'parameters': detection_parameters(args, k), 'shard': args.shard, 'shard_by': args.shard_by,
+            'tasks': tasks}
 
 def main(args):
-    global outfile, pbar, mode
     """
     SW comparison between SL1 and SL2
     read reads in bam
@@ -648,97 +1467,350 @@ def main(args):
         query name, 22nt sequence, SW score, SL1 score, SL2 score, SL1 cigar, SL2 cigar ,SL type
         query name, selected 22nt sequence with soft clipping...
     """
+    start_time = time.perf_counter()
     mode = args.mode
+    if args.output_format == 'parquet':
+        require_pyarrow()
     sl_dict = fasta_to_dict(args.refer)
-
-    # 生成10个长度为SL1长度的碱基的随机序列
-    ref_lengths = [len(key) for key in sl_dict.values()]
-    random_seq_len = round(sum(ref_lengths) / len(ref_lengths))
-    random.seed(826)
-    random_sequences_dict = {}
-    for i in range(10):
-        random_sequence = ''.join([random.choice('AGTC') for _ in range(random_seq_len)])
-        random_sequences_dict[i] = random_sequence
-
-    k = 5
-    kmer = extract_kmers(sl_dict, k)
-    mismatch_to_kmer = build_mismatch_index(sl_dict, k)
-    random_kmer = extract_kmers(random_sequences_dict, k)
-    random_mismatch_to_kmer = build_mismatch_index(random_sequences_dict, k)
-
-    length_scores = {}
-
-    SL_ref_length = get_sequences_by_length(sl_dict)
-    for SL, info in SL_ref_length.items():
-        length_score = length_index(SL, info['sequence'], kmer, mismatch_to_kmer, random_seq_len, k)
-        length_scores[len(info['sequence'])] = length_score
-
-    bam_file = pysam.AlignmentFile(args.input, 'rb')
-    timestamp = int(time.time())
-    tmp_output_name = f"tmp_{timestamp}.csv"
-    outfile = open(tmp_output_name, "w")
-    outfile.write("query_name\tstrand\tsoft_length\taligned_length\tread_end\tquery_length\tconsensus\trandom_sw_score\trandom_final_score\trandom_SL_score\tsw_score\tfinal_score\tSL_score\tSL_type\n")
-
-    # 迭代每个read
-    print('Loading the BAM file')
-    bam_list=[]
-    for read in bam_file.fetch():
-        if read.is_supplementary or read.is_secondary:
-            continue
-        ### sequence extract
-        query_name = read.query_name     # 获取query的名称
-        full_query_sequence = read.query_sequence  # 获取query的序列
-        if read.is_reverse:
-            strand = '-'
+    k = KMER_SIZE
+    detector = load_detector(sl_dict, k, args.index, args.null_table)
+
+    # 迭代每个read, the BAM is streamed and only a bounded number of batches is kept in memory
+    max_in_flight = args.cpu * 2
+    reader_profiler = None
+    if args.profile:
+        reader_profiler = StageProfiler()
+    shard = None
+    regions = None
+    name_shard = None
+    if args.shard is not None:
+        shard = parse_shard(args.shard)
+        if args.shard_by == 'region':
+            # the plan only depends on the BAM and N, so every node deals the same regions round-robin
+            regions = plan_regions(args.input, shard[1] * REGIONS_PER_SHARD)[shard[0] - 1::shard[1]]
         else:
-            strand = '+'
-        bam_list.append([query_name,full_query_sequence,strand,read.cigartuples,read.query_alignment_length])
-    pbar = tqdm(total=len(bam_list), position=0, leave=True)
+            name_shard = shard
+    if args.by_region:
+        # each worker fetches its own regions, rows still come back in region order
+        if regions is None:
+            regions = plan_regions(args.input, args.cpu * 4)
+        batches = [region + (name_shard,) for region in regions]
+        task = process_region
+    else:
+        batches = stream_batches(read_bam(args.input, mode, args.bam_threads, regions, name_shard, reader_profiler),
+                                 args.chunk_size, max_in_flight)
+        task = process_batch
+
+    checkpoint = None
+    if args.checkpoint or args.resume:
+        checkpoint = Checkpoint(args.output, run_fingerprint(args, sl_dict, k, regions), args.checkpoint_interval)
+        if args.resume and checkpoint.resume():
+            print('Resuming after ' + str(checkpoint.reads) + ' reads')
+            # tasks are replayed in the same order, the finished ones are skipped
+            batches = islice(batches, checkpoint.done, None)
+
+    # rows are sorted by query_name with an external merge sort in the scratch directory
+    writer = SortedResultWriter(table_path(args), RESULT_HEADER, tmp_dir=args.tmp_dir, buffer_rows=args.sort_buffer)
+    if checkpoint is not None:
+        checkpoint.start(writer.tmp_dir)
+    print('Reading the BAM file')
+    pbar = tqdm(position=0, leave=True, unit=' reads')
+    run_stats = Counter()
+    if checkpoint is not None and checkpoint.done > 0:
+        for block in checkpoint.saved_rows():
+            writer.write(block)
+        run_stats.update(checkpoint.run_stats)
+        pbar.update(checkpoint.reads)
+
+    detector_state = detector_settings(detector, args.index, args.clip_cache, args.max_clip, args.null_table_validate,
+                                       args.prefilter, args.prefilter_min_seeds, args.prefilter_validate, args.profile)
+    write = writer.write
+    if args.profile:
+        write = reader_profiler.wrap('output_writing', writer.write)
+    try:
+        with multiprocessing.Pool(processes=args.cpu, initializer=init_worker,
+                                  initargs=(detector_state, mode)) as pool:
+            for mes, stats, batch_size in run_batches(pool, batches, max_in_flight, task):
+                write(mes)
+                run_stats.update(stats)
+                pbar.update(batch_size)
+                if checkpoint is not None:
+                    checkpoint.add(mes, stats, batch_size)
+    except BaseException:
+        if checkpoint is not None:
+            checkpoint.close()
+        writer.abort()
+        raise
 
-    if mode == 'RNA':
-        with multiprocessing.Pool(processes=args.cpu) as pool:
-            for item in bam_list:
-                pool.apply_async(drs_calculation_per_process, args=(item, sl_dict, length_scores, random_sequences_dict,
-                                                                random_seq_len, random_kmer, random_mismatch_to_kmer,
-                                                                k, kmer, mismatch_to_kmer), callback=update)
-            pool.close()
-            pool.join()
-    elif mode == 'cDNA':
-        with multiprocessing.Pool(processes=args.cpu) as pool:
-            for item in bam_list:
-                pool.apply_async(cdna_calculation_per_process, args=(item, sl_dict, length_scores, random_sequences_dict,
-                                                                    random_seq_len, random_kmer,
-                                                                    random_mismatch_to_kmer,
-                                                                    k, kmer, mismatch_to_kmer), callback=update)
-            pool.close()
-            pool.join()
+    pbar.close()
+    close_start = time.perf_counter()
+    writer.close()
+    write_output_format(args)
+    if checkpoint is not None:
+        checkpoint.remove()
+    report_run_stats(run_stats)
+    if args.profile:
+        # the reader thread is done, its numbers can be read now
+        reader_profiler.add('output_writing', time.perf_counter() - close_start)
+        profile = run_stats + reader_profiler.take()
+        report_profile(profile_table(profile, PROFILE_STAGES, PROFILE_COUNTERS, time.perf_counter() - start_time),
+                       args.output + '.profile.json')
+    if shard is not None:
+        # the metadata marks the partial as complete, visualization waits for the merge
+        write_partial_metadata(args.output, {
+            'shard': list(shard), 'shard_by': args.shard_by, 'mode': mode,
+            'sl_reference': sl_checksum(sl_dict), 'bam': file_fingerprint(args.input),
+            'parameters': detection_parameters(args, k), 'rows': writer.rows, 'run_stats': dict(run_stats)})
+        print('Partial result of shard ' + args.shard + ' written, combine the shards with SL_detect.py merge')
+    elif args.visualization:
+        # plotting libraries take most of the start-up time, only load them when needed
+        from SLRanger.visualization import visualize_html
+        visualize_html(args.output, args.cutoff)
+    print('Finished')
+    print('Finished')
+
+def sample_output(args, sample):
+    if args.output_format == 'parquet':
+        return os.path.join(args.output, sample + '.parquet')
+    return os.path.join(args.output, sample + '.txt')
 
+def write_summary(path, samples, sl_names):
+    """
+    per-sample read counts by SL type, with a total line
+    """
+    columns = ['reads'] + sl_names + ['unknown', 'random']
+    total = Counter()
+    with open(path, 'w') as f:
+        f.write('\t'.join(['sample', 'bam', 'output'] + columns) + '\n')
+        for sample in samples:
+            f.write('\t'.join([sample['sample'], sample['bam'], sample['output']]
+                              + [str(sample['counts'][column]) for column in columns]) + '\n')
+            total.update(sample['counts'])
+        f.write('\t'.join(['total', '', ''] + [str(total[column]) for column in columns]) + '\n')
+
+def batch_main(args, samples):
+    """
+    several BAM files through one detector and one worker pool:
+    tasks of all files are queued back to back, so the pool never drains between files,
+    each sample gets <output>/<sample>.txt and <output>/summary.tsv counts the SL types of every sample
+    """
+    mode = args.mode
+    if args.output_format == 'parquet':
+        require_pyarrow()
+    sl_dict = fasta_to_dict(args.refer)
+    k = KMER_SIZE
+    detector = load_detector(sl_dict, k, args.index, args.null_table)
+    detector_state = detector_settings(detector, args.index, args.clip_cache, args.max_clip, args.null_table_validate,
+                                       args.prefilter, args.prefilter_min_seeds, args.prefilter_validate)
+    os.makedirs(args.output, exist_ok=True)
+    samples = [{'sample': sample, 'bam': bam_path, 'output': sample_output(args, sample), 'counts': Counter()}
+               for sample, bam_path in samples]
+    max_in_flight = args.cpu * 2
+
+    def sample_tasks():
+        for index, sample in enumerate(samples):
+            if args.by_region:
+                for region in plan_regions(sample['bam'], args.cpu * 4):
+                    yield index, True, region + (None,)
+            else:
+                for batch in chunked(read_bam(sample['bam'], mode, args.bam_threads), args.chunk_size):
+                    yield index, False, batch
+
+    def start(sample):
+        sample_args = copy.copy(args)
+        sample_args.output = sample['output']
+        sample['writer'] = SortedResultWriter(table_path(sample_args), RESULT_HEADER,
+                                              tmp_dir=args.tmp_dir, buffer_rows=args.sort_buffer)
+
+    def finish(sample):
+        sample.pop('writer').close()
+        sample_args = copy.copy(args)
+        sample_args.output = sample['output']
+        write_output_format(sample_args)
+        if args.visualization:
+            from SLRanger.visualization import visualize_html
+            visualize_html(sample['output'], args.cutoff)
+
+    print('Reading ' + str(len(samples)) + ' BAM files')
+    pbar = tqdm(position=0, leave=True, unit=' reads')
+    run_stats = Counter()
+    # results come back in submission order, so the samples finish one after the other
+    current = -1
+    try:
+        with multiprocessing.Pool(processes=args.cpu, initializer=init_worker,
+                                  initargs=(detector_state, mode)) as pool:
+            if args.by_region:
+                tasks = sample_tasks()
+            else:
+                tasks = prefetch(sample_tasks(), max_in_flight)
+            for index, mes, stats, batch_size in run_batches(pool, tasks, max_in_flight, process_sample_task):
+                while current < index:
+                    if current >= 0:
+                        finish(samples[current])
+                    current += 1
+                    start(samples[current])
+                sample = samples[index]
+                sample['writer'].write(mes)
+                counts = sample['counts']
+                counts['reads'] += batch_size
+                for row in mes.splitlines():
+                    SL_type = row.rsplit('\t', 1)[1]
+                    if SL_type.endswith('_unknown'):
+                        counts['unknown'] += 1
+                    else:
+                        counts[SL_type] += 1
+                run_stats.update(stats)
+                pbar.update(batch_size)
+            # the last samples, and BAM files without any read
+            while current < len(samples) - 1:
+                if current >= 0:
+                    finish(samples[current])
+                current += 1
+                start(samples[current])
+            finish(samples[current])
+    except BaseException:
+        for sample in samples:
+            if 'writer' in sample:
+                sample['writer'].abort()
+        raise
     pbar.close()
-    outfile.close()
-    df = pd.read_csv(tmp_output_name,sep='\t')
-    df.sort_values(by=['query_name'], inplace=True)
-    df.to_csv(args.output, index=False,sep='\t')
+    write_summary(os.path.join(args.output, 'summary.tsv'), samples, list(sl_dict))
+    report_run_stats(run_stats)
+    print('Summary of ' + str(len(samples)) + ' samples written to ' + os.path.join(args.output, 'summary.tsv'))
+    print('Finished')
+
+def merge_main(parser, args):
+    """
+    merge the partial results of --shard runs into the output of a single run
+    """
+    try:
+        metadata_list = merge_partials(args.partials, table_path(args))
+    except ValueError as error:
+        # unfinished or incompatible partials
+        parser.error(str(error))
+    write_output_format(args)
+    run_stats = Counter()
+    for metadata in metadata_list:
+        run_stats.update(metadata['run_stats'])
+    report_run_stats(run_stats)
     if args.visualization:
+        from SLRanger.visualization import visualize_html
         visualize_html(args.output, args.cutoff)
     print('Finished')
-    print('Finished')
 
-if __name__ == '__main__':
+def index_main(args):
+    """
+    build the detector state of the SL references once and save it for --index
+    """
+    sl_dict = fasta_to_dict(args.refer)
+    k = KMER_SIZE
+    detector = build_detector(sl_dict, k)
+    if args.null_table:
+        detector['null_table'] = build_null_table(detector)
+    write_index(args.output, detector, sl_checksum(sl_dict), index_parameters(k))
+    print('SL index written to ' + args.output)
+
+def add_output_format_args(parser):
+    parser.add_argument("--output-format", type=str, choices=['tsv', 'parquet'], default='tsv',
+                        help="tsv table or compressed parquet with typed columns, needs pyarrow (default: tsv)")
+    parser.add_argument("--columns", type=str, choices=['all', 'minimal'], default='all',
+                        help="minimal keeps query_name, the SW/SL scores and SL_type (parquet only, default: all)")
+
+if __name__ == '__main__' and sys.argv[1:2] == ['merge']:
+    parser = argparse.ArgumentParser(
+        prog="SL_detect.py merge", description="merge the partial results of SL_detect.py --shard runs")
+    parser.add_argument("partials", nargs='+', help="partial outputs of every shard")
+    parser.add_argument("-o", "--output", type=str, metavar="OUTPUT",
+                        default="SLRanger_ppssw.txt",
+                        help="output file")
+    parser.add_argument("-c", "--cutoff", type=float, default=4, help="cutoff of high confident SL sequence")
+    parser.add_argument("--visualization", action='store_true', help='Turn on the visualization mode')
+    add_output_format_args(parser)
+    args = parser.parse_args(sys.argv[2:])
+    check_output_args(parser, args)
+    merge_main(parser, args)
+elif __name__ == '__main__' and sys.argv[1:2] == ['index']:
+    parser = argparse.ArgumentParser(
+        prog="SL_detect.py index", description="pre-build the SL index used by SL_detect.py --index")
+    parser.add_argument("-r", "--refer", type=str, required=True, help="SL reference")
+    parser.add_argument("-o", "--output", type=str, metavar="INDEX", required=True, help="index file")
+    parser.add_argument("--null-table", action='store_true', help="also build the null score table for --null-table")
+    args = parser.parse_args(sys.argv[2:])
+    index_main(args)
+elif __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="help to know spliced leader and distinguish SL1 and SL2")
     parser.add_argument("-r", "--refer", type=str,required=True,
                         help="SL reference")
-    parser.add_argument("-i", "--input", type=str, metavar="",required=True,
-                        help="input the bam file")
-    parser.add_argument("-m", "--mode", type=str, metavar="", choices=['RNA','cDNA'],
+    parser.add_argument("-i", "--input", type=str, metavar="BAM", nargs='+',
+                        help="input the bam file, - reads an unsorted SAM/BAM stream from stdin; "
+                             "with several BAM files OUTPUT is a directory holding one result per sample")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="file listing BAM files, one per line as bam or sample<TAB>bam, processed like "
+                             "several --input files")
+    parser.add_argument("-m", "--mode", type=str, choices=['RNA','cDNA'],
                         default="RNA", help="RNA or cDNA")
-    parser.add_argument("-o", "--output", type=str, metavar="",
-                        default="SLRanger_ppssw.txt",
-                        help="output file")
+    parser.add_argument("-o", "--output", type=str, metavar="OUTPUT",
+                        help="output file (default: SLRanger_ppssw.txt), or the output directory with several "
+                             "BAM files (default: SLRanger_batch)")
     parser.add_argument("-c", "--cutoff", type=float, default=4, help="cutoff of high confident SL sequence")
     parser.add_argument("--visualization", action='store_true', help='Turn on the visualization mode')
     parser.add_argument("-t", "--cpu", type=int,
                         default=1,
                         help="number if CPU")
+    parser.add_argument("--chunk-size", type=int, default=100,
+                        help="number of reads sent to a worker per task (default: 100)")
+    parser.add_argument("--bam-threads", type=int, default=1,
+                        help="threads used by pysam to decompress the BAM (default: 1)")
+    add_output_format_args(parser)
+    parser.add_argument("--by-region", action='store_true',
+                        help="split the indexed BAM into regions read by the workers themselves")
+    parser.add_argument("--shard", type=str, default=None, metavar="i/N",
+                        help="only process shard i of N (1..N) and write a partial result for SL_detect.py merge")
+    parser.add_argument("--shard-by", type=str, choices=['name', 'region'], default='name',
+                        help="split shards by read-name hash or by indexed BAM region (default: name)")
+    parser.add_argument("--checkpoint", action='store_true',
+                        help="save the finished work in <output>.checkpoint so a failed run can be resumed")
+    parser.add_argument("--checkpoint-interval", type=int, default=300,
+                        help="seconds between two checkpoints (default: 300)")
+    parser.add_argument("--resume", action='store_true',
+                        help="continue from <output>.checkpoint after checking the BAM, SL references and parameters")
+    parser.add_argument("--index", type=str, metavar="INDEX",
+                        help="SL index built by SL_detect.py index from the same SL reference, skips the set-up")
+    parser.add_argument("--profile", action='store_true',
+                        help="report the time per stage and SW counters, also written to <output>.profile.json")
+    parser.add_argument("--clip-cache", type=int, default=10000,
+                        help="identical clips memoised per worker, 0 disables the cache (default: 10000)")
+    parser.add_argument("--tmp-dir", type=str, default=None,
+                        help="scratch directory for the sort runs (default: the output directory)")
+    parser.add_argument("--sort-buffer", type=int, default=500000,
+                        help="rows sorted in memory before spilling to the scratch directory (default: 500000)")
+    parser.add_argument("--max-clip", type=int, default=0,
+                        help="search at most the last MAX_CLIP bases of a soft clip, next to the alignment "
+                             "(0: the whole clip, otherwise at least the k-mer size 5, default: 0)")
+    parser.add_argument("--prefilter", action='store_true',
+                        help="label reads without SL k-mer seeds in the clip as random without alignment")
+    parser.add_argument("--prefilter-min-seeds", type=int, default=1,
+                        help="minimum number of SL seed k-mers for a read to pass the prefilter (default: 1)")
+    parser.add_argument("--prefilter-validate", action='store_true',
+                        help="score every read exactly and report how often the prefilter would change the call")
+    parser.add_argument("--null-table", action='store_true',
+                        help="take the random control from a precomputed table of expected random scores "
+                             "by clip length and GC content instead of 10 random alignments per clip")
+    parser.add_argument("--null-table-validate", type=float, metavar="PERCENT", default=0,
+                        help="with --null-table, also align this percentage of clips to the random references "
+                             "and report how often the call changes (default: 0)")
     args = parser.parse_args()
-    main(args)
+    check_output_args(parser, args)
+    check_run_args(parser, args)
+    samples = input_samples(args)
+    batch = len(samples) != 1 or args.manifest is not None
+    if args.output is None:
+        args.output = 'SLRanger_batch' if batch else 'SLRanger_ppssw.txt'
+    if not batch:
+        args.input = samples[0][1]
+        check_input_args(parser, args)
+        main(args)
+    else:
+        check_batch_args(parser, args, samples)
+        batch_main(args, samples)
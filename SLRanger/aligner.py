@@ -0,0 +1,82 @@
+from ctypes import c_int8, c_int32
+from pyssw.ssw_wrap import Aligner, PyAlignRes
+
+
+# same base coding as pyssw (A/C/G/T -> 0-3, anything else -> 4 as N)
+_BASE_TABLE = bytearray([4] * 256)
+for _base, _value in Aligner.base_to_int.items():
+    _BASE_TABLE[ord(_base)] = _value
+_BASE_TABLE = bytes(_BASE_TABLE)
+
+
+def encode_sequence(seq):
+    """
+    cast a DNA string into the c_int8 array expected by libssw,
+    without the per-base python loop of Aligner._DNA_to_int_mat
+    """
+    encoded = str(seq).encode('ascii', 'replace').translate(_BASE_TABLE)
+    return (c_int8 * len(encoded)).from_buffer_copy(encoded)
+
+
+class AlignerPool(object):
+    """
+    SSW engine over a fixed panel of references, kept for the lifetime of a worker process
+    references: {ref_id: sequence}
+    the references are encoded once; align_all builds the query profile once and sweeps every reference
+    """
+
+    def __init__(self, references, match=1, mismatch=1, gap_open=1, gap_extend=1):
+        self.references = dict(references)
+        # reduce the gap open score from 3 to 1 for nanopore reads
+        self.gap_open = gap_open
+        self.gap_extend = gap_extend
+        # scoring matrix filled exactly as pyssw does
+        self.mat = Aligner(match=match, mismatch=mismatch).mat
+        self.ref_arrays = {}
+        for ref_id, ref_seq in self.references.items():
+            self.ref_arrays[ref_id] = encode_sequence(ref_seq)
+
+    def align(self, ref_id, query, report_cigar=True):
+        """
+        align the query against the pre-built reference ref_id,
+        returns the PyAlignRes object of the SSW alignment
+        """
+        return self.align_all(query, [ref_id], report_cigar)[ref_id]
+
+    def align_all(self, query, ref_ids=None, report_cigar=True):
+        """
+        align one query against several references (default: the whole panel) in one call
+        returns {ref_id: PyAlignRes} with score, coordinates and, if requested, the cigar string
+        """
+        if ref_ids is None:
+            ref_ids = self.ref_arrays.keys()
+        query = str(query)
+        query_len = len(query)
+        # the profile keeps a pointer to the encoded query, it must stay referenced until init_destroy
+        query_array = encode_sequence(query)
+        profile = Aligner.ssw_init(query_array, c_int32(query_len), self.mat, 5, 2)
+        # same suboptimal mask as pyssw Aligner.align
+        if query_len > 30:
+            mask_len = query_len // 2
+        else:
+            mask_len = 15
+
+        # flag 1 always runs the traceback for the cigar, flag 8 only finds the begin positions (same coordinates)
+        if report_cigar:
+            flag = 1
+        else:
+            flag = 8
+        results = {}
+        try:
+            for ref_id in ref_ids:
+                ref_array = self.ref_arrays[ref_id]
+                c_result = Aligner.ssw_align(profile, ref_array, c_int32(len(ref_array)),
+                                             self.gap_open, self.gap_extend, flag, 0, 0, mask_len)
+                if c_result.contents.query_end - c_result.contents.query_begin + 1 >= 0:
+                    results[ref_id] = PyAlignRes(c_result, query_len, False, report_cigar)
+                else:
+                    results[ref_id] = None
+                Aligner.align_destroy(c_result)
+        finally:
+            Aligner.init_destroy(profile)
+        return results
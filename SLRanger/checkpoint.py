@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import time
+from collections import Counter
+from itertools import islice
+
+
+class Checkpoint(object):
+    """
+    durable progress of a SL_detect run, kept in <output>.checkpoint/
+    tasks come back in submission order, so the finished work is always the first `done` tasks;
+    their rows are appended to rows.tsv and state.json records how many tasks, reads and bytes are safe
+    fingerprint: whatever decides which rows a task produces (input, references, parameters, task split)
+    """
+
+    def __init__(self, output, fingerprint, interval=300):
+        self.directory = output + '.checkpoint'
+        self.state_path = os.path.join(self.directory, 'state.json')
+        self.rows_path = os.path.join(self.directory, 'rows.tsv')
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.done = 0
+        self.reads = 0
+        self.run_stats = Counter()
+        self.rows_file = None
+        self.scratch_dir = None
+        self.last_save = time.time()
+
+    def resume(self):
+        """
+        load the saved progress after checking it belongs to the same run,
+        returns False if there is nothing to resume
+        """
+        if not os.path.exists(self.state_path):
+            return False
+        with open(self.state_path) as f:
+            state = json.load(f)
+        for key, value in self.fingerprint.items():
+            if state['fingerprint'].get(key) != value:
+                raise ValueError('Checkpoint in ' + self.directory + ' was written for a different run ('
+                                 + key + ' differs), remove it or run without --resume')
+        self.done = state['done']
+        self.reads = state['reads']
+        self.run_stats = Counter(state['run_stats'])
+        # rows written after the last save belong to tasks that will run again
+        with open(self.rows_path, 'r+') as f:
+            f.truncate(state['rows_bytes'])
+        return True
+
+    def saved_rows(self, block_rows=10000):
+        """
+        the rows of the finished tasks, in blocks of joined rows
+        """
+        with open(self.rows_path) as f:
+            while True:
+                block = ''.join(islice(f, block_rows))
+                if not block:
+                    return
+                yield block
+
+    def start(self, scratch_dir=None):
+        """
+        scratch_dir: the sort directory of this run (SortedResultWriter.tmp_dir), recorded right away so the
+        next run removes it if this one is killed
+        """
+        self.remove_stale_scratch()
+        if self.done == 0:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory)
+        self.scratch_dir = scratch_dir
+        self.rows_file = open(self.rows_path, 'a')
+        self.save()
+
+    def remove_stale_scratch(self):
+        """
+        a killed run leaves its SLRanger_tmp_* sort directory behind, its rows are in the checkpoint anyway
+        """
+        try:
+            with open(self.state_path) as f:
+                scratch_dir = json.load(f).get('scratch_dir')
+        except (OSError, ValueError):
+            return
+        if scratch_dir and os.path.basename(scratch_dir).startswith('SLRanger_tmp_'):
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    def add(self, rows, stats, reads):
+        """
+        record one finished task, saved every `interval` seconds
+        """
+        self.rows_file.write(rows)
+        self.done += 1
+        self.reads += reads
+        self.run_stats.update(stats)
+        if time.time() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        self.rows_file.flush()
+        os.fsync(self.rows_file.fileno())
+        state = {'fingerprint': self.fingerprint, 'done': self.done, 'reads': self.reads,
+                 'rows_bytes': self.rows_file.tell(), 'run_stats': dict(self.run_stats),
+                 'scratch_dir': self.scratch_dir}
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+        self.last_save = time.time()
+
+    def close(self):
+        if self.rows_file is not None:
+            self.save()
+            self.rows_file.close()
+            self.rows_file = None
+
+    def remove(self):
+        """
+        the run finished, the output replaces the checkpoint
+        """
+        if self.rows_file is not None:
+            self.rows_file.close()
+            self.rows_file = None
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:  # parquet output is optional, pip install SLRanger[parquet]
+    pa = None
+
+
+PARQUET_MAGIC = b'PAR1'
+# columns needed to filter reads by score and SL type (e.g. operon_predict.py)
+MINIMAL_COLUMNS = ['query_name', 'random_sw_score', 'sw_score', 'random_SL_score', 'SL_score', 'SL_type']
+DICTIONARY_COLUMNS = ['strand', 'consensus', 'SL_type']
+INT_COLUMNS = ['soft_length', 'aligned_length', 'read_end', 'query_length', 'random_sw_score', 'sw_score']
+SCORE_COLUMNS = ['random_final_score', 'random_SL_score', 'final_score', 'SL_score']
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError('Parquet results need pyarrow, install it with: pip install pyarrow')
+
+
+def is_parquet(path):
+    with open(path, 'rb') as f:
+        return f.read(4) == PARQUET_MAGIC
+
+
+def result_schema(columns):
+    fields = []
+    for column in columns:
+        if column in DICTIONARY_COLUMNS:
+            fields.append(pa.field(column, pa.dictionary(pa.int32(), pa.string())))
+        elif column in INT_COLUMNS:
+            fields.append(pa.field(column, pa.int32()))
+        elif column in SCORE_COLUMNS:
+            fields.append(pa.field(column, pa.float32()))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    return pa.schema(fields)
+
+
+def tsv_to_parquet(tsv_path, output, columns=None, block_size=64 << 20):
+    """
+    convert a SL_detect result table into parquet, streaming one block of rows at a time
+    NA/None become nulls, SL_type/consensus/strand are dictionary encoded and scores stored as float32
+    columns: keep only these columns (e.g. MINIMAL_COLUMNS), default all
+    """
+    require_pyarrow()
+    with open(tsv_path) as f:
+        header = f.readline().rstrip('\n').split('\t')
+    if columns is None:
+        columns = header
+    # query_length is written as 12.0 (or nan) for some reads, it is parsed as a float and cast back
+    column_types = {column: pa.float64() if column in INT_COLUMNS + SCORE_COLUMNS else pa.string()
+                    for column in header}
+    reader = pa_csv.open_csv(
+        tsv_path,
+        read_options=pa_csv.ReadOptions(block_size=block_size),
+        parse_options=pa_csv.ParseOptions(delimiter='\t', quote_char=False),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types, include_columns=columns,
+                                              null_values=['NA', 'None', 'nan'], strings_can_be_null=True))
+    schema = result_schema(columns)
+    with pq.ParquetWriter(output, schema, compression='zstd') as writer:
+        for batch in reader:
+            arrays = []
+            for field in schema:
+                array = batch.column(field.name)
+                if pa.types.is_dictionary(field.type):
+                    array = pc.dictionary_encode(array).cast(field.type)
+                else:
+                    array = array.cast(field.type)
+                arrays.append(array)
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+
+
+def read_result_table(path, columns=None):
+    """
+    load a SL_detect result (tsv or parquet, detected from the file content) as a DataFrame
+    parquet columns come back with the dtypes pd.read_csv gives for the tsv
+    """
+    if not is_parquet(path):
+        if columns is None:
+            return pd.read_csv(path, sep='\t')
+        return pd.read_csv(path, sep='\t', usecols=columns)[columns]
+    require_pyarrow()
+    table = pq.read_table(path, columns=columns)
+    df = table.to_pandas()
+    for column in df.columns:
+        if column in DICTIONARY_COLUMNS:
+            df[column] = df[column].astype(object)
+        elif column in SCORE_COLUMNS:
+            # float32 storage, scores were written with 2 decimals
+            df[column] = np.round(df[column].astype('float64'), 2)
+        elif column in INT_COLUMNS and df[column].dtype.kind == 'i':
+            df[column] = df[column].astype('int64')
+    return df
@@ -0,0 +1,121 @@
+import multiprocessing
+from collections import Counter, namedtuple
+
+from SLRanger.columnar import INT_COLUMNS, SCORE_COLUMNS
+from SLRanger.SL_detect import (KMER_SIZE, RESULT_HEADER, fasta_to_dict, load_detector, detector_settings,
+                                make_worker_state, score_batch, init_worker, process_batch, read_item,
+                                primary_reads, read_bam, chunked, stream_batches, run_batches)
+
+
+RESULT_COLUMNS = RESULT_HEADER.rstrip('\n').split('\t')
+# one row of the SL_detect result table, missing values (NA, None, nan) are None
+SLResult = namedtuple('SLResult', RESULT_COLUMNS)
+MISSING_VALUES = {'NA', 'None', 'nan'}
+
+
+def parse_result(row):
+    """
+    result row (as written by SL_detect) -> SLResult with int / float / str fields
+    """
+    values = []
+    for column, value in zip(RESULT_COLUMNS, row.rstrip('\n').split('\t')):
+        if value in MISSING_VALUES:
+            value = None
+        elif column in INT_COLUMNS:
+            # columns mixing numbers and None are printed as floats, e.g. 12.0
+            value = int(float(value))
+        elif column in SCORE_COLUMNS:
+            value = float(value)
+        values.append(value)
+    return SLResult(*values)
+
+
+class Detector(object):
+    """
+    SL detection from python, built once from a SL FASTA and reused for any number of BAM files
+    the worker pool is started on first use and kept until close(), processes=0 scores in the calling process
+
+        with Detector('SL_list_cel.fa', mode='RNA', processes=4) as detector:
+            for result in detector.detect_bam('sample.bam'):
+                print(result.query_name, result.SL_type)
+
+    results come in input order (the command line tool sorts them by read name),
+    the counters of all reads scored so far are in detector.run_stats
+    """
+
+    def __init__(self, sl_reference, mode='RNA', processes=1, index=None, clip_cache=10000, max_clip=0,
+                 null_table=False, null_validate=0, prefilter=False, prefilter_min_seeds=1, chunk_size=100,
+                 start_method=None):
+        if mode not in ('RNA', 'cDNA'):
+            raise ValueError('mode must be RNA or cDNA, got ' + repr(mode))
+        if max_clip != 0 and max_clip < KMER_SIZE:
+            raise ValueError('max_clip must be 0 (whole clip) or at least ' + str(KMER_SIZE) + ', got ' + str(max_clip))
+        if null_validate and not null_table:
+            raise ValueError('null_validate checks the null_table calls, set null_table=True')
+        self.mode = mode
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.start_method = start_method
+        self.sl_dict = fasta_to_dict(sl_reference)
+        self.detector = load_detector(self.sl_dict, KMER_SIZE, index, null_table)
+        self.state = detector_settings(self.detector, index, clip_cache, max_clip, null_validate, prefilter,
+                                       prefilter_min_seeds, as_values=True)
+        self.worker_state = None
+        self.pool = None
+        self.run_stats = Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def score_items(self, items):
+        """
+        worker items (see SL_detect.read_item) -> SLResult, in input order
+        a generator dropped before the end stops the reading thread and waits for the submitted batches,
+        the detector can be used again right away
+        """
+        if self.processes <= 0:
+            if self.worker_state is None:
+                self.worker_state = make_worker_state(self.state, self.mode)
+            for batch in chunked(items, self.chunk_size):
+                rows, stats, _ = score_batch(batch, self.mode, self.worker_state)
+                self.run_stats.update(stats)
+                for values in rows:
+                    yield SLResult(*values)
+            return
+        if self.pool is None:
+            context = multiprocessing.get_context(self.start_method)
+            self.pool = context.Pool(processes=self.processes, initializer=init_worker,
+                                     initargs=(self.state, self.mode))
+        max_in_flight = self.processes * 2
+        results = run_batches(self.pool, stream_batches(items, self.chunk_size, max_in_flight),
+                              max_in_flight, process_batch)
+        try:
+            for rows, stats, _ in results:
+                self.run_stats.update(stats)
+                for values in rows:
+                    yield SLResult(*values)
+        finally:
+            results.close()
+
+    def detect(self, records):
+        """
+        score alignment records (pysam AlignedSegment), yields one SLResult per primary alignment
+        """
+        items = (read_item(read, self.mode) for read in primary_reads(records))
+        return self.score_items(items)
+
+    def detect_bam(self, path, threads=1):
+        """
+        score the primary alignments of a BAM file ('-' reads a SAM/BAM stream from stdin)
+        threads: extra threads used by pysam for BGZF decompression
+        """
+        return self.score_items(read_bam(path, self.mode, threads))
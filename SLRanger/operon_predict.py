@@ -5,6 +5,8 @@ from pathlib import Path
 
 import pandas as pd
 
+from SLRanger.columnar import read_result_table
+
 try:
     from SLRanger.run_ex_function import run_track_cluster
 except ImportError:
@@ -171,7 +173,7 @@ def standardize_sl_type(sl_type, sl1_refs, sl2_refs, legacy_mapping=False):
 def sl_process(path, cf, sl1_refs, sl2_refs, legacy_mapping=False):
     output_columns = ['query_name', 'SL_type', 'SL']
     try:
-        sl = pd.read_csv(path, sep='\t')
+        sl = read_result_table(path)
     except pd.errors.EmptyDataError:
         return pd.DataFrame(columns=output_columns)
 
@@ -0,0 +1,82 @@
+import json
+from collections import Counter
+from time import perf_counter
+
+
+SECONDS_PREFIX = 'profile_seconds:'
+CALLS_PREFIX = 'profile_calls:'
+
+
+class StageProfiler(object):
+    """
+    wall time and call count per stage, plus plain counters (e.g. sw_calls)
+    only built with --profile, the hot path never checks for it: timed wrappers are installed instead
+    """
+
+    def __init__(self):
+        self.stats = Counter()
+
+    def add(self, stage, seconds, calls=1):
+        self.stats[SECONDS_PREFIX + stage] += seconds
+        self.stats[CALLS_PREFIX + stage] += calls
+
+    def count(self, name, value=1):
+        self.stats[name] += value
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, perf_counter() - start)
+        return timed
+
+    def timed_iter(self, stage, iterable):
+        """
+        time spent producing every item of iterable (e.g. decoding BAM records)
+        """
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, perf_counter() - start, 0)
+                return
+            self.add(stage, perf_counter() - start)
+            yield item
+
+    def take(self):
+        """
+        hand the numbers over (worker -> parent with the batch stats) and start again from zero
+        """
+        stats = self.stats
+        self.stats = Counter()
+        return stats
+
+
+def profile_table(run_stats, stages, counters, wall_seconds):
+    """
+    Returns the --profile summary as a dict: per-stage seconds/calls and the counters
+    """
+    table = {'wall_seconds': round(wall_seconds, 3), 'stages': {}, 'counters': {}}
+    for stage in stages:
+        table['stages'][stage] = {'seconds': round(run_stats[SECONDS_PREFIX + stage], 3),
+                                  'calls': run_stats[CALLS_PREFIX + stage]}
+    for name in counters:
+        table['counters'][name] = run_stats[name]
+    return table
+
+
+def report_profile(table, json_path):
+    print('Profile (seconds are summed over all processes, nested stages are included in their parent)')
+    print('{:<22}{:>14}{:>14}'.format('stage', 'calls', 'seconds'))
+    for stage, values in table['stages'].items():
+        print('{:<22}{:>14}{:>14.3f}'.format(stage, values['calls'], values['seconds']))
+    for name, value in table['counters'].items():
+        print('{:<22}{:>14}'.format(name, value))
+    print('{:<22}{:>28.3f}'.format('wall time', table['wall_seconds']))
+    with open(json_path, 'w') as f:
+        json.dump(table, f, indent=2)
+    print('Profile written to ' + json_path)
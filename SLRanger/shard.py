@@ -0,0 +1,136 @@
+import hashlib
+import heapq
+import json
+import os
+import zlib
+
+from SLRanger.sorted_writer import row_key
+
+
+PARTIAL_FORMAT = 'SLRanger-partial/1'
+FINGERPRINT_BLOCK = 1 << 20
+
+
+def parse_shard(spec):
+    """
+    'i/N' -> (i, N), shards are numbered from 1 to N
+    """
+    try:
+        index, count = [int(value) for value in spec.split('/')]
+    except ValueError:
+        raise ValueError('Shard must look like i/N, got ' + repr(spec))
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError('Shard index must be between 1 and N, got ' + repr(spec))
+    return index, count
+
+
+def in_shard(query_name, shard):
+    """
+    read-name hash sharding, crc32 is stable across nodes and python runs (unlike hash())
+    """
+    index, count = shard
+    return zlib.crc32(query_name.encode()) % count == index - 1
+
+
+def sl_checksum(sl_dict):
+    """
+    md5 of the parsed SL references, in file order since ties are broken by the first SL
+    """
+    md5 = hashlib.md5()
+    for name, seq in sl_dict.items():
+        md5.update(('>' + name + '\n' + seq + '\n').encode())
+    return md5.hexdigest()
+
+
+def file_fingerprint(path):
+    """
+    size and md5 of the first and last MiB, cheap enough for BAM files of any size
+    """
+    size = os.path.getsize(path)
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        md5.update(f.read(FINGERPRINT_BLOCK))
+        if size > FINGERPRINT_BLOCK:
+            f.seek(max(FINGERPRINT_BLOCK, size - FINGERPRINT_BLOCK))
+            md5.update(f.read(FINGERPRINT_BLOCK))
+    return {'size': size, 'md5': md5.hexdigest()}
+
+
+def metadata_path(output):
+    return output + '.shard.json'
+
+
+def write_partial_metadata(output, metadata):
+    """
+    written after the partial output is complete, a partial without it is unfinished
+    """
+    metadata = dict(metadata, format=PARTIAL_FORMAT)
+    tmp_path = metadata_path(output) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(metadata, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, metadata_path(output))
+
+
+def read_partial_metadata(output):
+    path = metadata_path(output)
+    if not os.path.exists(path):
+        raise ValueError(output + ' has no ' + os.path.basename(path) + ', the shard did not finish')
+    with open(path) as f:
+        metadata = json.load(f)
+    if metadata.get('format') != PARTIAL_FORMAT:
+        raise ValueError(path + ' is not a SLRanger partial result')
+    return metadata
+
+
+def check_partials(metadata_list):
+    """
+    all partials must come from the same input, references and parameters, and cover every shard once
+    """
+    first = metadata_list[0]
+    for metadata in metadata_list[1:]:
+        for key in ['mode', 'sl_reference', 'bam', 'parameters', 'shard_by']:
+            if metadata[key] != first[key]:
+                raise ValueError('Partials disagree on ' + key + ': '
+                                 + json.dumps(first[key]) + ' vs ' + json.dumps(metadata[key]))
+    counts = set(metadata['shard'][1] for metadata in metadata_list)
+    if len(counts) > 1:
+        raise ValueError('Partials were cut into different shard counts: ' + str(sorted(counts)))
+    count = counts.pop()
+    indexes = sorted(metadata['shard'][0] for metadata in metadata_list)
+    if indexes != list(range(1, count + 1)):
+        missing = sorted(set(range(1, count + 1)) - set(indexes))
+        duplicated = sorted(set(index for index in indexes if indexes.count(index) > 1))
+        raise ValueError('Shards do not cover 1/' + str(count) + '..' + str(count) + '/' + str(count)
+                         + ' exactly once, missing ' + str(missing) + ', duplicated ' + str(duplicated))
+
+
+def _partial_rows(path, header, counter):
+    with open(path) as f:
+        if f.readline() != header:
+            raise ValueError(path + ' has a different header')
+        for row in f:
+            counter[path] += 1
+            yield row
+
+
+def merge_partials(partials, output):
+    """
+    validate the partial results and merge them (each sorted by query_name) into the output
+    returns the metadata of every partial
+    """
+    metadata_list = [read_partial_metadata(path) for path in partials]
+    check_partials(metadata_list)
+    with open(partials[0]) as f:
+        header = f.readline()
+    counter = dict.fromkeys(partials, 0)
+    tmp_path = output + '.tmp'
+    with open(tmp_path, 'w') as out:
+        out.write(header)
+        out.writelines(heapq.merge(*[_partial_rows(path, header, counter) for path in partials], key=row_key))
+    for path, metadata in zip(partials, metadata_list):
+        if counter[path] != metadata['rows']:
+            os.remove(tmp_path)
+            raise ValueError(path + ' holds ' + str(counter[path]) + ' rows but its metadata records '
+                             + str(metadata['rows']))
+    os.replace(tmp_path, output)
+    return metadata_list
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+
+INDEX_FORMAT = 'SLRanger-index/1'
+INDEX_MAGIC = b'SLRIDX01'
+# magic, header length
+PREFIX = struct.Struct('<8sQ')
+ALIGNMENT = 8
+
+
+def index_key(sl_reference, parameters):
+    """
+    checksum of the SL references (shard.sl_checksum) and of every parameter the derived state depends on
+    """
+    key = json.dumps({'sl_reference': sl_reference, 'parameters': parameters}, sort_keys=True)
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def pack_kmer_index(kmer_index):
+    """
+    CSR layout of a build_kmer_index table: uint32 offsets (4^k + 1) and uint16 positions,
+    an empty range stands for None since a k-mer hit always has at least one position
+    """
+    offsets = [0]
+    positions = []
+    for hit in kmer_index:
+        if hit is not None:
+            positions.extend(hit)
+        offsets.append(len(positions))
+    return (struct.pack('<%dI' % len(offsets), *offsets),
+            struct.pack('<%dH' % len(positions), *positions))
+
+
+def unpack_kmer_index(offsets, positions):
+    kmer_index = []
+    for code in range(len(offsets) - 1):
+        start, end = offsets[code], offsets[code + 1]
+        if start == end:
+            kmer_index.append(None)
+        else:
+            kmer_index.append(tuple(positions[start:end]))
+    return kmer_index
+
+
+def write_index(path, state, sl_reference, parameters):
+    """
+    write the detector state of SL_detect.build_detector:
+    a JSON header (references, random controls, length scores, array table) followed by the k-mer tables
+    """
+    arrays = []
+    tables = []
+    offset = 0
+    for kind, indexes in [('sl', state['kmer_index']), ('random', state['random_kmer_index'])]:
+        for name, kmer_index in indexes.items():
+            offsets, positions = pack_kmer_index(kmer_index)
+            table = {'kind': kind, 'name': name}
+            for field, data in [('offsets', offsets), ('positions', positions)]:
+                table[field] = [offset, len(data)]
+                padding = -len(data) % ALIGNMENT
+                arrays.append(data + b'\0' * padding)
+                offset += len(data) + padding
+            tables.append(table)
+    header = {
+        'format': INDEX_FORMAT,
+        'key': index_key(sl_reference, parameters),
+        'sl_reference': sl_reference,
+        'parameters': parameters,
+        'k': state['k'],
+        'sl_dict': list(state['sl_dict'].items()),
+        'random_sequences_dict': list(state['random_sequences_dict'].items()),
+        'random_seq_len': state['random_seq_len'],
+        'length_scores': [[length, list(scores.items())] for length, scores in state['length_scores'].items()],
+        'tables': tables,
+        # build_null_table output, only present when the index was built with --null-table
+        'null_table': state.get('null_table'),
+    }
+    header = json.dumps(header).encode()
+    header += b' ' * (-(PREFIX.size + len(header)) % ALIGNMENT)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(PREFIX.pack(INDEX_MAGIC, len(header)))
+        f.write(header)
+        for data in arrays:
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_index(path, sl_reference=None, parameters=None):
+    """
+    map an index file read-only and rebuild the detector state,
+    with sl_reference/parameters given the index must have been built from them
+    """
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            magic, header_length = PREFIX.unpack_from(mapped)
+            if magic != INDEX_MAGIC:
+                raise ValueError(path + ' is not a SLRanger index')
+            header = json.loads(bytes(mapped[PREFIX.size:PREFIX.size + header_length]))
+            if header['format'] != INDEX_FORMAT:
+                raise ValueError(path + ' has index format ' + str(header['format']) + ', rebuild it')
+            if sl_reference is not None and header['key'] != index_key(sl_reference, parameters):
+                raise ValueError(path + ' was built for other SL references or parameters, '
+                                 'rebuild it with SL_detect.py index')
+            data = memoryview(mapped)[PREFIX.size + header_length:]
+            state = {'kmer_index': {}, 'random_kmer_index': {}}
+            for table in header['tables']:
+                start, length = table['offsets']
+                offsets = data[start:start + length].cast('I')
+                start, length = table['positions']
+                positions = data[start:start + length].cast('H')
+                kmer_index = unpack_kmer_index(offsets, positions)
+                offsets.release()
+                positions.release()
+                if table['kind'] == 'sl':
+                    state['kmer_index'][table['name']] = kmer_index
+                else:
+                    state['random_kmer_index'][table['name']] = kmer_index
+            data.release()
+    state.update({
+        'k': header['k'],
+        'sl_dict': dict(header['sl_dict']),
+        'random_sequences_dict': dict(header['random_sequences_dict']),
+        'random_seq_len': header['random_seq_len'],
+        'length_scores': {length: dict(scores) for length, scores in header['length_scores']},
+    })
+    if header.get('null_table') is not None:
+        state['null_table'] = header['null_table']
+    return state
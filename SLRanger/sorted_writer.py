@@ -0,0 +1,96 @@
+import heapq
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+
+def row_key(row):
+    return row.split('\t', 1)[0]
+
+
+class SortedResultWriter(object):
+    """
+    write tab-separated rows sorted by their first column (query_name) with bounded memory
+    blocks of rows are handed to a writer thread; rows are sorted in memory runs of
+    buffer_rows, spilled to a private scratch directory and k-way merged on close
+    """
+
+    def __init__(self, output, header, tmp_dir=None, buffer_rows=500000, max_queued=64):
+        self.output = output
+        self.header = header
+        self.buffer_rows = buffer_rows
+        if tmp_dir is None:
+            tmp_dir = os.path.dirname(os.path.abspath(output))
+        # a private directory per run, so concurrent runs never share tmp names
+        self.tmp_dir = tempfile.mkdtemp(prefix='SLRanger_tmp_', dir=tmp_dir)
+        self.buffer = []
+        self.runs = []
+        self.rows = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.thread = threading.Thread(target=self._consume, daemon=True)
+        self.thread.start()
+
+    def write(self, block):
+        """
+        queue a block of '\\n' terminated rows
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put(block)
+
+    def close(self):
+        """
+        flush the writer thread, merge the sorted runs into the output and remove the scratch directory
+        """
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            if self.error is not None:
+                raise self.error
+            run_files = [open(path) for path in self.runs]
+            try:
+                self.buffer.sort(key=row_key)
+                with open(self.output, 'w') as out:
+                    out.write(self.header)
+                    out.writelines(heapq.merge(*run_files, self.buffer, key=row_key))
+            finally:
+                for f in run_files:
+                    f.close()
+        finally:
+            self.buffer = []
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def abort(self):
+        """
+        stop the writer thread and remove the scratch directory without writing the output
+        """
+        self.queue.put(None)
+        self.thread.join()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _consume(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                rows = block.splitlines(keepends=True)
+                self.rows += len(rows)
+                self.buffer.extend(rows)
+                if len(self.buffer) >= self.buffer_rows:
+                    self._spill()
+            except Exception as e:
+                self.error = e
+
+    def _spill(self):
+        self.buffer.sort(key=row_key)
+        path = os.path.join(self.tmp_dir, 'run_' + str(len(self.runs)) + '.tsv')
+        with open(path, 'w') as f:
+            f.writelines(self.buffer)
+        self.runs.append(path)
+        self.buffer = []
@@ -10,6 +10,7 @@ from datetime import datetime
 import seaborn as sns
 import matplotlib.colors as mcolors
 import warnings
+from SLRanger.columnar import read_result_table
 # 隐藏特定的警告
 warnings.filterwarnings('ignore', category=FutureWarning)
 warnings.filterwarnings('ignore', category=DeprecationWarning)  # 如果使用plotnine可能需要
@@ -345,7 +346,7 @@ def visualize_html(output_file, cf):
     # 创建文件夹
     os.makedirs(folder_name, exist_ok=True)
     # Read data
-    df = pd.read_csv(path, sep='\t')
+    df = read_result_table(path)
     reads_all = len(df)
     df = df.dropna()
     reads_na = len(df)
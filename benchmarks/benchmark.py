@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+"""
+offline end-to-end benchmark of SL_detect.py and operon_predict.py on synthetic data
+
+a reproducible genome with operon-like gene clusters is generated together with a sorted, indexed BAM,
+a GFF annotation and a read-to-gene mapping; the 5′ soft clips carry SL1/SL2 sequences from
+sample/SL_list_cel.fa (SL1 for the first gene of a cluster, SL2 variants downstream) or random sequence.
+both CLIs of this checkout are run over a grid of read counts and --cpu values and the wall time,
+reads/s, peak memory (whole process tree and largest single process) and speedup of every run are written
+to a JSON report
+
+python benchmarks/benchmark.py --sizes 2000 20000 --cpus 1 2 4 -o benchmark_report.json
+python benchmarks/benchmark.py --sizes 2000 20000 --cpus 1 2 4 --compare old_report.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pysam
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SL_DETECT = os.path.join(REPO, 'SLRanger', 'SL_detect.py')
+OPERON_PREDICT = os.path.join(REPO, 'SLRanger', 'operon_predict.py')
+SL_FASTA = os.path.join(REPO, 'sample', 'SL_list_cel.fa')
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+
+def read_fasta(path):
+    sequences = {}
+    name = None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                name = line[1:]
+                sequences[name] = ''
+            elif name is not None:
+                sequences[name] += line.upper()
+    return sequences
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def random_seq(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def add_errors(rng, seq, rate):
+    """
+    nanopore-like substitutions, deletions and insertions in equal parts
+    """
+    out = []
+    for base in seq:
+        r = rng.random()
+        if r < rate / 3:
+            continue
+        if r < 2 * rate / 3:
+            out.append(rng.choice('ACGT'))
+        elif r < rate:
+            out.append(base + rng.choice('ACGT'))
+        else:
+            out.append(base)
+    return ''.join(out)
+
+
+def plan_genes(rng, n_genes, n_contigs=3):
+    """
+    clusters of 1-3 genes on the same strand. Returns ({contig: length}, [gene dict])
+    """
+    genes = []
+    contigs = {}
+    per_contig = -(-n_genes // n_contigs)
+    for contig_index in range(n_contigs):
+        contig = 'chr' + str(contig_index + 1)
+        position = rng.randint(500, 2000)
+        count = 0
+        while count < per_contig and len(genes) < n_genes:
+            cluster_size = rng.choice([1, 1, 2, 2, 3])
+            strand = rng.choice('+-')
+            cluster = []
+            for _ in range(cluster_size):
+                length = rng.randint(600, 1500)
+                cluster.append({'contig': contig, 'start': position, 'end': position + length, 'strand': strand})
+                position += length + rng.randint(100, 300)
+            # the gene next to the promoter receives SL1, the others SL2
+            if strand == '-':
+                cluster.reverse()
+            for rank, gene in enumerate(cluster):
+                gene['name'] = 'gene' + str(len(genes) + 1)
+                gene['downstream'] = rank > 0
+                genes.append(gene)
+            count += cluster_size
+            position += rng.randint(1000, 3000)
+        contigs[contig] = position + rng.randint(500, 2000)
+    return contigs, genes
+
+
+def write_gff(path, genes):
+    with open(path, 'w') as f:
+        for gene in sorted(genes, key=lambda g: (g['contig'], g['start'])):
+            fields = [gene['contig'], 'synthetic', None, str(gene['start'] + 1), str(gene['end']), '.',
+                      gene['strand'], None, None]
+            for feature, phase, attributes in [
+                    ('gene', '.', 'ID=' + gene['name']),
+                    ('mRNA', '.', 'ID=tx_' + gene['name'] + ';Parent=' + gene['name']),
+                    ('CDS', '0', 'Parent=tx_' + gene['name'])]:
+                fields[2], fields[7], fields[8] = feature, phase, attributes
+                f.write('\t'.join(fields) + '\n')
+
+
+def make_clip(rng, gene, sl_dict, sl_fraction, clip_length, no_clip_fraction, error_rate):
+    """
+    5′ clip of one read (RNA orientation): SL (+ a few random bases) or random sequence, '' for no clip
+    """
+    if rng.random() < sl_fraction:
+        if gene['downstream']:
+            sl_name = rng.choice([name for name in sl_dict if name != 'SL1'])
+        else:
+            sl_name = 'SL1'
+        sl_seq = sl_dict[sl_name][rng.choice([0, 0, 0, rng.randint(1, 8)]):]
+        return random_seq(rng, rng.randint(0, 5)) + add_errors(rng, sl_seq, error_rate)
+    if rng.random() < no_clip_fraction:
+        return ''
+    return random_seq(rng, max(1, int(rng.expovariate(1 / clip_length))))
+
+
+def generate_dataset(directory, n_reads, seed=826, sl_fraction=0.4, clip_length=30, no_clip_fraction=0.2,
+                     error_rate=0.08, secondary_fraction=0.02):
+    """
+    write reads.bam (+ .bai), genes.gff and mapping.tsv into directory. Returns their paths
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    sl_dict = read_fasta(SL_FASTA)
+    contigs, genes = plan_genes(rng, max(20, n_reads // 40))
+    genome = {contig: random_seq(rng, length) for contig, length in contigs.items()}
+    contig_ids = {contig: index for index, contig in enumerate(contigs)}
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': contig, 'LN': length} for contig, length in contigs.items()]}
+    reads = []
+    mapping = []
+    for i in range(n_reads):
+        gene = rng.choice(genes)
+        gene_length = gene['end'] - gene['start']
+        aligned_length = rng.randint(min(200, gene_length), gene_length)
+        # full length reads start at the gene 5′ end, the rest are 3′ biased fragments
+        offset = 0 if rng.random() < 0.7 else rng.randint(0, gene_length - aligned_length)
+        if gene['strand'] == '+':
+            start = gene['start'] + offset
+        else:
+            start = gene['end'] - offset - aligned_length
+        body = genome[gene['contig']][start:start + aligned_length]
+        clip_5 = make_clip(rng, gene, sl_dict, sl_fraction, clip_length, no_clip_fraction, error_rate)
+        clip_3 = random_seq(rng, rng.randint(1, 20)) if rng.random() < 0.3 else ''
+        if gene['strand'] == '+':
+            left, right = clip_5, clip_3
+        else:
+            left, right = reverse_complement(clip_3), reverse_complement(clip_5)
+        cigar = [(0, aligned_length)]
+        if left:
+            cigar.insert(0, (4, len(left)))
+        if right:
+            cigar.append((4, len(right)))
+        name = 'read' + str(rng.randint(0, 10 ** 8)).zfill(8) + '_' + str(i)
+        for flag in [0, 256] if rng.random() < secondary_fraction else [0]:
+            reads.append((contig_ids[gene['contig']], start, name, left + body + right, cigar,
+                          flag | (16 if gene['strand'] == '-' else 0)))
+        mapping.append(name + '\t' + gene['name'] + '\n')
+
+    bam_path = os.path.join(directory, 'reads.bam')
+    with pysam.AlignmentFile(bam_path, 'wb', header=header) as out:
+        for contig_id, start, name, seq, cigar, flag in sorted(reads, key=lambda read: read[:2]):
+            read = pysam.AlignedSegment(out.header)
+            read.query_name = name
+            read.query_sequence = seq
+            read.flag = flag
+            read.reference_id = contig_id
+            read.reference_start = start
+            read.mapping_quality = 60
+            read.cigartuples = cigar
+            out.write(read)
+    pysam.index(bam_path)
+    gff_path = os.path.join(directory, 'genes.gff')
+    write_gff(gff_path, genes)
+    mapping_path = os.path.join(directory, 'mapping.tsv')
+    with open(mapping_path, 'w') as f:
+        f.writelines(mapping)
+    return bam_path, gff_path, mapping_path
+
+
+def process_tree(pid):
+    """
+    pid and all its descendants, from /proc (Linux)
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/' + entry + '/stat') as f:
+                # the command name may hold spaces, the fields after it are fixed
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+
+def tree_memory_kb(pid):
+    """
+    memory of the whole process tree in KB: the sum of the proportional set sizes (Pss), so the pages that
+    forked workers share with the parent are counted once; None where /proc/<pid>/smaps_rollup is missing
+    """
+    total = 0
+    for tree_pid in process_tree(pid):
+        try:
+            with open('/proc/' + str(tree_pid) + '/smaps_rollup') as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            if tree_pid == pid:
+                return None
+    return total
+
+
+def run_command(command, log_path, interval=0.05):
+    """
+    run one CLI of this checkout.
+    Returns (seconds, peak memory in MB of the whole process tree sampled every interval seconds (None off Linux),
+    max single-process peak RSS in MB)
+    """
+    env = dict(os.environ, PYTHONPATH=REPO + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    tree_peak = 0
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+        while True:
+            # ru_maxrss of wait4 is the largest peak of the process and its reaped workers (KB on Linux),
+            # not their sum, the tree is sampled for that
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            if tree_peak is not None:
+                memory = tree_memory_kb(process.pid)
+                tree_peak = None if memory is None else max(tree_peak, memory)
+            time.sleep(interval)
+        seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError('Benchmark command failed, see ' + log_path + ': ' + ' '.join(command))
+    return seconds, None if tree_peak is None else tree_peak / 1024, usage.ru_maxrss / 1024
+
+
+def memory_fields(peak_tree, peak_process):
+    return {'peak_tree_mb': None if peak_tree is None else round(peak_tree, 1),
+            'max_process_rss_mb': round(peak_process, 1)}
+
+
+def run_grid(args, work_dir):
+    runs = []
+    for n_reads in args.sizes:
+        data_dir = os.path.join(work_dir, str(n_reads))
+        os.makedirs(data_dir, exist_ok=True)
+        print('Generating ' + str(n_reads) + ' reads')
+        bam_path, gff_path, mapping_path = generate_dataset(
+            data_dir, n_reads, seed=args.seed, sl_fraction=args.sl_fraction, clip_length=args.clip_length,
+            no_clip_fraction=args.no_clip_fraction, error_rate=args.error_rate)
+        for mode in args.modes:
+            sl_output = None
+            for cpu in args.cpus:
+                for repeat in range(args.repeats):
+                    output = os.path.join(data_dir, mode + '_cpu' + str(cpu) + '.txt')
+                    command = [sys.executable, SL_DETECT, '-r', SL_FASTA, '-i', bam_path, '-m', mode,
+                               '-o', output, '-t', str(cpu)] + args.sl_detect_args.split()
+                    seconds, peak_tree, peak_process = run_command(command, output + '.log')
+                    runs.append(dict({'tool': 'SL_detect', 'mode': mode, 'reads': n_reads, 'cpu': cpu,
+                                      'repeat': repeat, 'seconds': round(seconds, 3),
+                                      'reads_per_s': round(n_reads / seconds, 1)},
+                                     **memory_fields(peak_tree, peak_process)))
+                    print_run(runs[-1])
+                    sl_output = output
+            if 'operon_predict' in args.tools:
+                for repeat in range(args.repeats):
+                    output = os.path.join(data_dir, mode + '_operon.gff')
+                    command = [sys.executable, OPERON_PREDICT, '-g', gff_path, '-m', mapping_path,
+                               '-i', sl_output, '-o', output]
+                    seconds, peak_tree, peak_process = run_command(command, output + '.log')
+                    runs.append(dict({'tool': 'operon_predict', 'mode': mode, 'reads': n_reads, 'cpu': 1,
+                                      'repeat': repeat, 'seconds': round(seconds, 3),
+                                      'reads_per_s': round(n_reads / seconds, 1)},
+                                     **memory_fields(peak_tree, peak_process)))
+                    print_run(runs[-1])
+    add_speedup(runs)
+    return runs
+
+
+def add_speedup(runs):
+    """
+    speedup against the smallest --cpu of the same tool, mode and size (best of the repeats)
+    """
+    best = {}
+    for run in runs:
+        key = (run['tool'], run['mode'], run['reads'], run['cpu'])
+        best[key] = min(best.get(key, run['seconds']), run['seconds'])
+    for run in runs:
+        base_cpu = min(key[3] for key in best if key[:3] == (run['tool'], run['mode'], run['reads']))
+        run['speedup'] = round(best[(run['tool'], run['mode'], run['reads'], base_cpu)] / run['seconds'], 2)
+
+
+def print_run(run):
+    if run['peak_tree_mb'] is None:
+        tree = '{:>8}'.format('NA')
+    else:
+        tree = '{:>8.1f}'.format(run['peak_tree_mb'])
+    print('{tool:>14} {mode:>5} {reads:>9} reads  cpu {cpu:>3}  {seconds:>9.2f} s  {reads_per_s:>10.1f} reads/s'
+          '  tree {tree} MB  max process {max_process_rss_mb:>8.1f} MB'.format(tree=tree, **run))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', '-C', REPO, 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_reports(runs, baseline_path):
+    """
+    print the wall time ratio (baseline / current) of every run found in both reports
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    old = {}
+    for run in baseline['runs']:
+        key = (run['tool'], run['mode'], run['reads'], run['cpu'])
+        old[key] = min(old.get(key, run['seconds']), run['seconds'])
+    print('Compared with ' + baseline_path + ' (' + str(baseline['environment'].get('git_commit')) + ')')
+    seen = set()
+    for run in runs:
+        key = (run['tool'], run['mode'], run['reads'], run['cpu'])
+        if key in old and key not in seen:
+            seen.add(key)
+            current = min(r['seconds'] for r in runs if (r['tool'], r['mode'], r['reads'], r['cpu']) == key)
+            print('{:>14} {:>5} {:>9} reads  cpu {:>3}  {:>9.2f} s -> {:>9.2f} s  x{:.2f}'.format(
+                *key, old[key], current, old[key] / current))
+
+
+def main(args):
+    if args.work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='SLRanger_bench_')
+    else:
+        work_dir = args.work_dir
+        os.makedirs(work_dir, exist_ok=True)
+    runs = run_grid(args, work_dir)
+    report = {
+        'environment': {'timestamp': datetime.now().isoformat(timespec='seconds'), 'git_commit': git_commit(),
+                        'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count()},
+        'parameters': {'sizes': args.sizes, 'cpus': args.cpus, 'modes': args.modes, 'repeats': args.repeats,
+                       'seed': args.seed, 'sl_fraction': args.sl_fraction, 'clip_length': args.clip_length,
+                       'no_clip_fraction': args.no_clip_fraction, 'error_rate': args.error_rate,
+                       'sl_detect_args': args.sl_detect_args},
+        'runs': runs,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Report written to ' + args.output + ', data kept in ' + work_dir)
+    if args.compare:
+        compare_reports(runs, args.compare)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="offline benchmark of SL_detect.py and operon_predict.py")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 10000], help="read counts (default: 1000 10000)")
+    parser.add_argument("--cpus", type=int, nargs='+', default=[1, 2, 4], help="--cpu values (default: 1 2 4)")
+    parser.add_argument("--modes", nargs='+', choices=['RNA', 'cDNA'], default=['RNA'], help="default: RNA")
+    parser.add_argument("--tools", nargs='+', choices=['SL_detect', 'operon_predict'],
+                        default=['SL_detect', 'operon_predict'], help="default: both")
+    parser.add_argument("--repeats", type=int, default=1, help="runs per grid point (default: 1)")
+    parser.add_argument("--seed", type=int, default=826, help="seed of the synthetic data (default: 826)")
+    parser.add_argument("--sl-fraction", type=float, default=0.4, help="reads with a SL clip (default: 0.4)")
+    parser.add_argument("--clip-length", type=float, default=30,
+                        help="mean length of the random (non-SL) clips, exponential (default: 30)")
+    parser.add_argument("--no-clip-fraction", type=float, default=0.2,
+                        help="non-SL reads without a 5' clip (default: 0.2)")
+    parser.add_argument("--error-rate", type=float, default=0.08, help="error rate in the SL clips (default: 0.08)")
+    parser.add_argument("--sl-detect-args", type=str, default='',
+                        help="extra SL_detect.py options, e.g. '--prefilter --by-region'")
+    parser.add_argument("--work-dir", type=str, default=None, help="where data and outputs are kept (default: tmp)")
+    parser.add_argument("-o", "--output", type=str, default='benchmark_report.json', help="JSON report")
+    parser.add_argument("--compare", type=str, default=None, help="earlier report to compare the wall times with")
+    main(parser.parse_args())
@@ -37,5 +37,8 @@ setup(
         'Markdown>=3.5',
         'seaborn>0.12.0'
     ],
+    extras_require={
+        'parquet': ['pyarrow>=10.0.0']
+    },
     scripts=['SLRanger/SL_detect.py','SLRanger/operon_predict.py','SLRanger/add_gene.py']
 )
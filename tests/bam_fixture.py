@@ -0,0 +1,67 @@
+"""
+small synthetic SL references and indexed BAM files shared by the tests
+"""
+import os
+import random
+
+import pysam
+
+
+SL_DICT = {'SL1': 'GGTTTAATTACCCAAGTTTGAG', 'SL2': 'GGTTTTAACCCAGTTACTCAAG'}
+
+
+def write_sl_fasta(directory, sl_dict=SL_DICT, name='SL.fa'):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        for SL, seq in sl_dict.items():
+            f.write('>' + SL + '\n' + seq + '\n')
+    return path
+
+
+def random_seq(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def clipped_read(name, start, clip, body, contig=0):
+    """
+    a forward read whose 5′ soft clip (possibly empty) is followed by an aligned body
+    """
+    cigar = ([(4, len(clip))] if clip else []) + [(0, len(body))]
+    return name, contig, start, clip + body, cigar
+
+
+def write_bam(path, reads, contigs=(('chrI', 5000),)):
+    """
+    reads: (name, contig index, start, sequence, cigartuples), written in coordinate order and indexed
+    """
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': SN, 'LN': LN} for SN, LN in contigs]}
+    with pysam.AlignmentFile(path, 'wb', header=header) as out:
+        for name, contig, start, seq, cigar in sorted(reads, key=lambda read: (read[1], read[2], read[0])):
+            read = pysam.AlignedSegment(out.header)
+            read.query_name = name
+            read.query_sequence = seq
+            read.flag = 0
+            read.reference_id = contig
+            read.reference_start = start
+            read.mapping_quality = 60
+            read.cigartuples = cigar
+            out.write(read)
+    pysam.index(path)
+    return path
+
+
+def sl_reads(n_reads, prefix='read', seed=826):
+    """
+    n_reads reads 50 bp apart, the clip is SL1, SL2 or random sequence (None in the returned truth)
+    Returns (reads, {name: SL or None})
+    """
+    rng = random.Random(seed)
+    reads = []
+    truth = {}
+    for i in range(n_reads):
+        SL = rng.choice(['SL1', 'SL2', None])
+        clip = SL_DICT[SL] if SL else random_seq(rng, rng.randint(0, 30))
+        name = prefix + str(i)
+        reads.append(clipped_read(name, i * 50, clip, random_seq(rng, 100)))
+        truth[name] = SL
+    return reads, truth
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from SLRanger.checkpoint import Checkpoint
+
+
+FINGERPRINT = {'bam': {'size': 10, 'md5': 'abc'}, 'mode': 'RNA', 'tasks': {'chunk_size': 100}}
+
+
+class CheckpointTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.tmp_dir, 'out.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_resume_keeps_saved_tasks_only(self):
+        checkpoint = Checkpoint(self.output, FINGERPRINT, interval=3600)
+        checkpoint.start()
+        checkpoint.add('a\t1\nb\t2\n', {'hits': 1}, 2)
+        checkpoint.save()
+        # not saved yet when the run dies
+        checkpoint.add('c\t3\n', {'hits': 5}, 1)
+        checkpoint.rows_file.flush()
+
+        resumed = Checkpoint(self.output, FINGERPRINT)
+        self.assertTrue(resumed.resume())
+        self.assertEqual((resumed.done, resumed.reads, resumed.run_stats['hits']), (1, 2, 1))
+        self.assertEqual(''.join(resumed.saved_rows(block_rows=1)), 'a\t1\nb\t2\n')
+        resumed.start()
+        resumed.add('c\t3\n', {'hits': 5}, 1)
+        resumed.close()
+        self.assertEqual(''.join(Checkpoint(self.output, FINGERPRINT).saved_rows()), 'a\t1\nb\t2\nc\t3\n')
+        resumed.remove()
+        self.assertFalse(os.path.exists(self.output + '.checkpoint'))
+
+    def test_resume_removes_the_killed_run_scratch(self):
+        scratch = tempfile.mkdtemp(prefix='SLRanger_tmp_', dir=self.tmp_dir)
+        checkpoint = Checkpoint(self.output, FINGERPRINT, interval=3600)
+        checkpoint.start(scratch)
+        # killed before the first interval save
+        checkpoint.add('a\t1\n', {}, 1)
+        checkpoint.rows_file.flush()
+
+        resumed = Checkpoint(self.output, FINGERPRINT)
+        self.assertTrue(resumed.resume())
+        self.assertEqual(resumed.done, 0)
+        new_scratch = tempfile.mkdtemp(prefix='SLRanger_tmp_', dir=self.tmp_dir)
+        resumed.start(new_scratch)
+        self.assertFalse(os.path.exists(scratch))
+        self.assertTrue(os.path.exists(new_scratch))
+        resumed.remove()
+
+    def test_refuses_other_run(self):
+        checkpoint = Checkpoint(self.output, FINGERPRINT)
+        checkpoint.start()
+        checkpoint.close()
+        self.assertFalse(Checkpoint(os.path.join(self.tmp_dir, 'other.txt'), FINGERPRINT).resume())
+        with self.assertRaises(ValueError):
+            Checkpoint(self.output, dict(FINGERPRINT, mode='cDNA')).resume()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+import pandas as pd
+
+from SLRanger import columnar as COLUMNAR
+from SLRanger import operon_predict as OPERON
+
+
+HEADER = ('query_name\tstrand\tsoft_length\taligned_length\tread_end\tquery_length\tconsensus\trandom_sw_score\t'
+          'random_final_score\trandom_SL_score\tsw_score\tfinal_score\tSL_score\tSL_type\n')
+ROWS = [
+    'read1\t+\t30\t900\t24\t22\tGGTTTAATTACCCAAGTTTGAG\t9\t6.13\t3.27\t22\t21.5\t9.87\tSL1\n',
+    'read2\t-\tNA\t850\tNA\tNA\tNA\tNA\tNA\tNA\tNA\tNA\tNA\trandom\n',
+    'read3\t+\t12\t700\t3\tNone\tNone\t0\t0\t0\t0\t0\t0\trandom\n',
+    'read4\t-\t41\t1200\t28\t19.0\tGGTTTTAACCCAGTTACTCAAG\t7\t4.5\t2.25\t18\t17.25\t8.5\tSL2\n',
+    'read5\t+\t15\t640\t6\tnan\tGGTTTAAT\t5\t3.1\t1.5\t6\t5.25\t2.0\trandom\n',
+]
+
+
+@unittest.skipIf(COLUMNAR.pa is None, 'pyarrow is not installed')
+class ColumnarTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.tsv = Path(self.temp_dir.name) / 'result.txt'
+        self.tsv.write_text(HEADER + ''.join(ROWS * 50))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_parquet_reads_back_like_the_tsv(self):
+        parquet = Path(self.temp_dir.name) / 'result.parquet'
+        COLUMNAR.tsv_to_parquet(self.tsv, parquet, block_size=1024)
+        self.assertTrue(COLUMNAR.is_parquet(parquet))
+        self.assertFalse(COLUMNAR.is_parquet(self.tsv))
+        pd.testing.assert_frame_equal(COLUMNAR.read_result_table(parquet), pd.read_csv(self.tsv, sep='\t'))
+        schema = COLUMNAR.pq.read_schema(parquet)
+        self.assertTrue(COLUMNAR.pa.types.is_dictionary(schema.field('SL_type').type))
+        self.assertEqual(schema.field('SL_score').type, COLUMNAR.pa.float32())
+
+    def test_minimal_columns(self):
+        parquet = Path(self.temp_dir.name) / 'result.parquet'
+        COLUMNAR.tsv_to_parquet(self.tsv, parquet, columns=COLUMNAR.MINIMAL_COLUMNS)
+        table = COLUMNAR.read_result_table(parquet)
+        self.assertEqual(list(table.columns), COLUMNAR.MINIMAL_COLUMNS)
+        pd.testing.assert_frame_equal(table, pd.read_csv(self.tsv, sep='\t')[COLUMNAR.MINIMAL_COLUMNS])
+
+    def test_operon_input_is_detected(self):
+        parquet = Path(self.temp_dir.name) / 'result.parquet'
+        COLUMNAR.tsv_to_parquet(self.tsv, parquet, columns=COLUMNAR.MINIMAL_COLUMNS)
+        expected = OPERON.sl_process(self.tsv, 4, {'SL1'}, {'SL2'})
+        pd.testing.assert_frame_equal(OPERON.sl_process(parquet, 4, {'SL1'}, {'SL2'}), expected)
+        self.assertEqual(len(expected), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    import pysam
+    from SLRanger.detector import Detector, SLResult, parse_result
+    from SLRanger.SL_detect import make_worker_state, read_bam, score_batch
+    from tests.bam_fixture import SL_DICT, sl_reads, write_bam, write_sl_fasta
+except ImportError:  # pysam / pyssw are not installed in the packaging job
+    Detector = None
+
+
+@unittest.skipIf(Detector is None, 'SL_detect dependencies are not installed')
+class DetectorTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sl_path = write_sl_fasta(self.tmp_dir)
+        reads, self.expected = sl_reads(60)
+        self.bam_path = write_bam(os.path.join(self.tmp_dir, 'reads.bam'), reads)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check(self, results):
+        names = sorted(self.expected, key=lambda name: int(name[4:]))
+        self.assertEqual([result.query_name for result in results], names)
+        for result in results:
+            if self.expected[result.query_name] is not None:
+                self.assertEqual(result.SL_type, self.expected[result.query_name])
+                self.assertIsInstance(result.SL_score, float)
+                self.assertIsInstance(result.sw_score, int)
+
+    def test_in_process_and_pool_agree(self):
+        with Detector(self.sl_path, processes=0) as detector:
+            local = list(detector.detect_bam(self.bam_path))
+            # the same detector is reused for a second input
+            with pysam.AlignmentFile(self.bam_path, 'rb') as bam_file:
+                self.assertEqual(list(detector.detect(bam_file.fetch())), local)
+            self.assertGreater(detector.run_stats['random_alignments_skipped'], 0)
+        self.check(local)
+        with Detector(self.sl_path, processes=2, chunk_size=7) as detector:
+            self.assertEqual(list(detector.detect_bam(self.bam_path)), local)
+            self.assertEqual(list(detector.detect_bam(self.bam_path)), local)
+
+    def test_detectors_keep_their_own_aligners(self):
+        sl1_path = write_sl_fasta(self.tmp_dir, {'SL1': SL_DICT['SL1']}, 'SL1.fa')
+        with Detector(self.sl_path, processes=0) as both, Detector(sl1_path, processes=0) as sl1_only:
+            expected = list(both.detect_bam(self.bam_path))
+            sl1_results = list(sl1_only.detect_bam(self.bam_path))
+            self.assertEqual(list(both.detect_bam(self.bam_path)), expected)
+            self.assertIsNot(both.worker_state['aligner_pool'], sl1_only.worker_state['aligner_pool'])
+        self.assertNotIn('SL2', [result.SL_type for result in sl1_results])
+        self.check(expected)
+
+    def test_spawn_workers(self):
+        with Detector(self.sl_path, mode='cDNA', processes=1, start_method='spawn') as detector:
+            results = list(detector.detect_bam(self.bam_path))
+        with Detector(self.sl_path, mode='cDNA', processes=0) as detector:
+            self.assertEqual(list(detector.detect_bam(self.bam_path)), results)
+        self.check(results)
+
+    def test_dropped_iterator_leaves_the_detector_usable(self):
+        for processes in (0, 2):
+            with Detector(self.sl_path, processes=processes, chunk_size=3) as detector:
+                expected = list(detector.detect_bam(self.bam_path))
+                threads = threading.active_count()
+                results = detector.detect_bam(self.bam_path)
+                self.assertEqual([next(results) for _ in range(10)], expected[:10])
+                results.close()
+                self.assertEqual(threading.active_count(), threads)
+                self.assertEqual(list(detector.detect_bam(self.bam_path)), expected)
+                # dropped without close, while the reading thread is still ahead of the workers
+                results = detector.detect_bam(self.bam_path)
+                next(results)
+                del results
+                self.assertEqual(list(detector.detect_bam(self.bam_path)), expected)
+
+    def test_results_match_the_table_rows(self):
+        for mode in ('RNA', 'cDNA'):
+            for max_clip in (0, 12):
+                with Detector(self.sl_path, mode=mode, processes=0, max_clip=max_clip) as detector:
+                    results = list(detector.detect_bam(self.bam_path))
+                    state = dict(detector.state)
+                    del state['as_values']
+                rows, _, _ = score_batch(list(read_bam(self.bam_path, mode)), mode, make_worker_state(state, mode))
+                self.assertEqual(results, [parse_result(row) for row in rows.splitlines()])
+
+    def test_parse_result(self):
+        row = 'read2\t-\tNA\t850\tNA\tNA\tNA\tNA\tNA\tNA\tNA\tNA\tNA\trandom\n'
+        self.assertEqual(parse_result(row), SLResult('read2', '-', None, 850, *([None] * 9), 'random'))
+        row = 'read3\t+\t12\t700\t3.0\tnan\tNone\t0.0\t0.0\t0.0\t0.0\t0.0\t0.0\trandom\n'
+        result = parse_result(row)
+        self.assertEqual((result.read_end, result.query_length, result.consensus, result.SL_score), (3, None, None, 0.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+
+from SLRanger.profiling import StageProfiler, profile_table
+
+
+class StageProfilerTests(unittest.TestCase):
+    def test_wrap_and_iter_are_counted(self):
+        profiler = StageProfiler()
+        double = profiler.wrap('double', lambda x: 2 * x)
+        self.assertEqual([double(x) for x in profiler.timed_iter('read', range(3))], [0, 2, 4])
+        profiler.count('sw_calls', 5)
+        table = profile_table(profiler.take(), ['read', 'double', 'unused'], ['sw_calls'], 1.0)
+        self.assertEqual(table['stages']['read']['calls'], 3)
+        self.assertEqual(table['stages']['double']['calls'], 3)
+        self.assertEqual(table['stages']['unused'], {'seconds': 0, 'calls': 0})
+        self.assertEqual(table['counters'], {'sw_calls': 5})
+        # take() hands the numbers over and starts again
+        self.assertEqual(profiler.take(), {})
+
+    def test_wrapped_exception_is_still_timed(self):
+        profiler = StageProfiler()
+
+        def fail():
+            raise KeyError('x')
+        with self.assertRaises(KeyError):
+            profiler.wrap('fail', fail)()
+        self.assertEqual(profiler.stats['profile_calls:fail'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from SLRanger.shard import (parse_shard, in_shard, sl_checksum, write_partial_metadata, merge_partials)
+
+
+HEADER = 'query_name\tSL_type\n'
+
+
+class ShardTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_partial(self, name, lines, shard, **changes):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write(HEADER)
+            f.writelines(lines)
+        metadata = {'shard': list(shard), 'shard_by': 'name', 'mode': 'RNA', 'sl_reference': 'abc',
+                    'bam': {'size': 1, 'md5': 'def'}, 'parameters': {'k': 5}, 'rows': len(lines),
+                    'run_stats': {}}
+        metadata.update(changes)
+        write_partial_metadata(path, metadata)
+        return path
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('2/8'), (2, 8))
+        for spec in ['0/4', '5/4', '1/0', '3', 'a/b']:
+            with self.assertRaises(ValueError):
+                parse_shard(spec)
+
+    def test_name_shards_partition_reads(self):
+        names = ['read' + str(i) for i in range(1000)]
+        owners = [[index for index in range(1, 5) if in_shard(name, (index, 4))] for name in names]
+        self.assertTrue(all(len(owner) == 1 for owner in owners))
+
+    def test_sl_checksum_follows_reference_order(self):
+        self.assertNotEqual(sl_checksum({'SL1': 'GGTTT', 'SL2': 'GGTTA'}), sl_checksum({'SL2': 'GGTTA', 'SL1': 'GGTTT'}))
+
+    def test_merge_sorts_rows(self):
+        first = self.write_partial('p1.txt', ['a\tSL1\n', 'c\trandom\n'], (1, 2))
+        second = self.write_partial('p2.txt', ['b\tSL2\n', 'd\tSL1\n'], (2, 2))
+        output = os.path.join(self.tmp_dir, 'merged.txt')
+        merge_partials([second, first], output)
+        with open(output) as f:
+            self.assertEqual(f.read(), HEADER + 'a\tSL1\nb\tSL2\nc\trandom\nd\tSL1\n')
+
+    def test_merge_rejects_incompatible_partials(self):
+        output = os.path.join(self.tmp_dir, 'merged.txt')
+        first = self.write_partial('p1.txt', ['a\tSL1\n'], (1, 2))
+        other_mode = self.write_partial('p2.txt', ['b\tSL1\n'], (2, 2), mode='cDNA')
+        with self.assertRaises(ValueError):
+            merge_partials([first, other_mode], output)
+        with self.assertRaises(ValueError):
+            merge_partials([first], output)
+        truncated = self.write_partial('p3.txt', ['b\tSL1\n'], (2, 2), rows=2)
+        with self.assertRaises(ValueError):
+            merge_partials([first, truncated], output)
+        self.assertFalse(os.path.exists(output))
+        unfinished = os.path.join(self.tmp_dir, 'p4.txt')
+        with open(unfinished, 'w') as f:
+            f.write(HEADER)
+        with self.assertRaises(ValueError):
+            merge_partials([first, unfinished], output)
+
+
+if __name__ == '__main__':
+    unittest.main()
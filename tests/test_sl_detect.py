@@ -0,0 +1,540 @@
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import pandas as pd
+
+try:
+    import pysam
+    from Bio.Seq import Seq
+    from SLRanger import SL_detect as DETECT
+    from tests.bam_fixture import SL_DICT, clipped_read, random_seq, write_bam, write_sl_fasta
+except ImportError:  # pysam / pyssw are not installed in the packaging job
+    DETECT = None
+
+
+def dataframe_selection(SL_sw_dict):
+    # per-read winner selection as it was written before select_sl
+    SL_sw_df = pd.DataFrame.from_dict(SL_sw_dict, orient='index')
+    SL_sw_df_s = SL_sw_df[SL_sw_df['SL_score'] > SL_sw_df['random_SL_score']]
+    sl_max = SL_sw_df_s['SL_score'].max()
+    filtered_df = SL_sw_df_s[SL_sw_df_s['SL_score'] == sl_max]
+    if len(filtered_df) > 1:
+        return '\t'.join([str(value) for value in filtered_df.iloc[0]]) + '\t' + filtered_df.index[0] + '_unknown'
+    elif len(filtered_df) == 1:
+        return '\t'.join([str(value) for value in filtered_df.iloc[0]]) + '\t' + filtered_df.index[0]
+    filtered_df_s = SL_sw_df[SL_sw_df['SL_score'] == SL_sw_df['SL_score'].max()]
+    return '\t'.join([str(value) for value in filtered_df_s.iloc[0]]) + '\t' + 'random'
+
+
+def list_find_best_match(query, mismatch_to_kmer, kmer_to_refs, k):
+    # list-based k-mer lookup used before build_kmer_index
+    encoded_query = [query[i:i+k] for i in range(len(query) - k + 1)]
+    ref_positions = []
+    max_consecutive = 0
+    for query_kmer in encoded_query:
+        if query_kmer in kmer_to_refs:
+            if kmer_to_refs.count(query_kmer) > 1:
+                ref_positions.extend(index for index, kmer in enumerate(kmer_to_refs) if kmer == query_kmer)
+            else:
+                ref_positions.append(kmer_to_refs.index(query_kmer))
+        elif query_kmer in mismatch_to_kmer:
+            original_kmer = mismatch_to_kmer[query_kmer]
+            if original_kmer in kmer_to_refs:
+                ref_positions.append(kmer_to_refs.index(original_kmer))
+    max_intersection = len(set(ref_positions))
+    if max_intersection > 0:
+        max_consecutive, _ = DETECT.longest_consecutive(ref_positions)
+    if max_consecutive > len(query) - k:
+        max_intersection = max_consecutive
+    return max_intersection, max_consecutive
+
+
+def char_consensus(ref, query, cigar_string):
+    # consensus as it was written before the per-run version, one base at a time
+    cons = []
+    query_pos = 0
+    ref_pos = 0
+    cigar_pattern = re.findall(r"([0-9]+)b?'?([MIDNSHP=X])", cigar_string)
+    for i, (length, code) in enumerate(cigar_pattern):
+        if (i == 0 or i == len(cigar_pattern) - 1) and code == "S":
+            continue
+        for _ in range(int(length)):
+            if code == "M":
+                q_s = query[query_pos].upper()
+                try:
+                    r_s = ref[ref_pos].upper()
+                except IndexError:
+                    pass
+                cons.append(q_s if q_s == r_s else "m")
+                ref_pos += 1
+                query_pos += 1
+            elif code == "D":
+                r_s = ref[ref_pos]
+                cons.append("d")
+                ref_pos += 1
+            elif code in "IHS":
+                cons.append("i")
+                query_pos += 1
+    return "".join(cons)
+
+
+def soft_processed(sequence, strand, cigar):
+    # clip extraction as it was written before clip_window, on the reverse-complemented read
+    if not cigar:
+        return ""
+    if strand == "+":
+        if cigar[0][0] == 4:
+            return sequence[:cigar[0][1] + 2]
+    elif strand == "-":
+        if cigar[-1][0] == 4:
+            return sequence[:cigar[-1][1] + 2]
+    else:
+        return ""
+
+
+def mutate(rng, seq, rate):
+    out = []
+    for base in seq:
+        r = rng.random()
+        if r < rate / 3:
+            continue
+        if r < 2 * rate / 3:
+            out.append(rng.choice('ACGTN'))
+        else:
+            out.append(base)
+    return ''.join(out)
+
+
+def scored_record(rng, scores):
+    return {
+        'read_end': rng.randint(5, 40),
+        'query_length': rng.randint(5, 30),
+        'consensus': rng.choice(['GGTTTAATTACCCAAGTTTGAG', 'CCAGTTAACTAAm', 'GGTTTdAAAC']),
+        'random_sw_score': rng.randint(0, 12),
+        'random_final_score': round(rng.choice([0, rng.uniform(0, 15)]), 2),
+        'random_SL_score': rng.choice(scores),
+        'sw_score': rng.randint(0, 22),
+        'final_score': round(rng.choice([0, rng.uniform(0, 30)]), 2),
+        'SL_score': rng.choice(scores),
+    }
+
+
+def short_record(rng):
+    # alignment shorter than k
+    return {
+        'read_end': rng.randint(0, 5),
+        'query_length': None,
+        'consensus': None,
+        'random_sw_score': 0,
+        'random_final_score': 0,
+        'random_SL_score': 0,
+        'sw_score': 0,
+        'final_score': 0,
+        'SL_score': 0,
+    }
+
+
+@unittest.skipIf(DETECT is None, 'SL_detect dependencies are not installed')
+class SelectSLTests(unittest.TestCase):
+    def selection(self, SL_sw_dict):
+        SL, SL_type = DETECT.select_sl(SL_sw_dict)
+        return DETECT.format_sl_record(SL_sw_dict, SL) + '\t' + SL_type
+
+    def test_single_winner(self):
+        rng = random.Random(1)
+        SL_sw_dict = {'SL1': scored_record(rng, [1.0]), 'SL2': scored_record(rng, [1.0])}
+        SL_sw_dict['SL1'].update({'SL_score': 12.5, 'random_SL_score': 3.1})
+        SL_sw_dict['SL2'].update({'SL_score': 9.0, 'random_SL_score': 3.1})
+        self.assertEqual(DETECT.select_sl(SL_sw_dict), ('SL1', 'SL1'))
+
+    def test_tie_is_unknown_with_first_reference(self):
+        rng = random.Random(2)
+        SL_sw_dict = {SL: scored_record(rng, [1.0]) for SL in ['SL1', 'SL2', 'SL3']}
+        SL_sw_dict['SL1'].update({'SL_score': 2.0, 'random_SL_score': 1.0})
+        SL_sw_dict['SL2'].update({'SL_score': 8.0, 'random_SL_score': 1.0})
+        SL_sw_dict['SL3'].update({'SL_score': 8.0, 'random_SL_score': 1.0})
+        self.assertEqual(DETECT.select_sl(SL_sw_dict), ('SL2', 'SL2_unknown'))
+
+    def test_random_fallback_reports_highest_score(self):
+        rng = random.Random(3)
+        SL_sw_dict = {SL: scored_record(rng, [1.0]) for SL in ['SL1', 'SL2']}
+        SL_sw_dict['SL1'].update({'SL_score': 2.0, 'random_SL_score': 5.0})
+        SL_sw_dict['SL2'].update({'SL_score': 4.0, 'random_SL_score': 5.0})
+        self.assertEqual(DETECT.select_sl(SL_sw_dict), ('SL2', 'random'))
+
+    def test_matches_dataframe_selection(self):
+        rng = random.Random(826)
+        scores = [0, 0.0, 1.5, 3.25, 3.25, 7.0, 12.8]
+        for _ in range(2000):
+            SL_sw_dict = {}
+            for i in range(rng.randint(1, 13)):
+                if rng.random() < 0.3:
+                    SL_sw_dict['SL' + str(i + 1)] = short_record(rng)
+                else:
+                    SL_sw_dict['SL' + str(i + 1)] = scored_record(rng, scores)
+            self.assertEqual(self.selection(SL_sw_dict), dataframe_selection(SL_sw_dict))
+
+
+@unittest.skipIf(DETECT is None, 'SL_detect dependencies are not installed')
+class KmerIndexTests(unittest.TestCase):
+    SL = {
+        'SL1': 'GGTTTAATTACCCAAGTTTGAG',
+        'SL2': 'GGTTTTAACCCAGTTACTCAAG',
+        'SL10': 'GGTTTTAACCCAAGTTAACCAAG',
+        'SL12': 'GTTTTAACCCATATAACCAAG',
+        'repeat': 'AAAAAAAAGGTTTAAAAAAA',
+    }
+
+    def test_encode_kmer_rejects_non_acgt(self):
+        self.assertEqual(DETECT.encode_kmer('AAAAA'), 0)
+        self.assertEqual(DETECT.encode_kmer('TTTTT'), 4 ** 5 - 1)
+        self.assertIsNone(DETECT.encode_kmer('AANAA'))
+        self.assertIsNone(DETECT.encode_kmer('aaaaa'))
+
+    def test_matches_list_lookup(self):
+        k = 5
+        kmer = DETECT.extract_kmers(self.SL, k)
+        mismatch_to_kmer = DETECT.build_mismatch_index(self.SL, k)
+        kmer_index = DETECT.build_kmer_indexes(kmer, mismatch_to_kmer, k)
+        rng = random.Random(826)
+        for _ in range(3000):
+            source = rng.choice(list(self.SL.values()) + [''.join(rng.choice('ACGT') for _ in range(25))])
+            query = rng.choice('ACGT') * rng.randint(0, 3) + mutate(rng, source, rng.choice([0, 0.1, 0.3]))
+            for SL in self.SL:
+                expected = list_find_best_match(query, mismatch_to_kmer, kmer[SL], k)
+                self.assertEqual(DETECT.find_best_match(query, kmer_index[SL], k)[:2], expected)
+
+    def test_seed_table_counts_sl_kmers(self):
+        k = 5
+        kmer = DETECT.extract_kmers(self.SL, k)
+        mismatch_to_kmer = DETECT.build_mismatch_index(self.SL, k)
+        seed_table = DETECT.build_seed_table(DETECT.build_kmer_indexes(kmer, mismatch_to_kmer, k), k)
+        sl1 = self.SL['SL1']
+        self.assertEqual(DETECT.count_seed_hits(sl1, seed_table, k), len(sl1) - k + 1)
+        self.assertEqual(DETECT.count_seed_hits('NNNNNNNNNN', seed_table, k), 0)
+        self.assertEqual(DETECT.count_seed_hits('GGTT', seed_table, k), 0)
+
+
+@unittest.skipIf(DETECT is None, 'SL_detect dependencies are not installed')
+class ClipCacheTests(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = DETECT.ClipCache(2)
+        cache.put(('RNA', 'AAAA'), {'SL_type': 'SL1'})
+        cache.put(('RNA', 'CCCC'), {'SL_type': 'SL2'})
+        self.assertEqual(cache.get(('RNA', 'AAAA')), {'SL_type': 'SL1'})
+        cache.put(('cDNA', 'AAAA'), {'SL_type': 'random'})
+        self.assertIsNone(cache.get(('RNA', 'CCCC')))
+        self.assertEqual(cache.get(('RNA', 'AAAA')), {'SL_type': 'SL1'})
+        self.assertEqual(cache.get(('cDNA', 'AAAA')), {'SL_type': 'random'})
+
+
+@unittest.skipIf(DETECT is None, 'SL_detect dependencies are not installed')
+class ConsensusTests(unittest.TestCase):
+    SL = {'SL1': 'GGTTTAATTACCCAAGTTTGAG', 'SL2': 'GGTTTTAACCCAGTTACTCAAG'}
+
+    def test_matches_char_consensus(self):
+        pool = DETECT.AlignerPool(self.SL)
+        rng = random.Random(826)
+        for _ in range(1000):
+            SL = rng.choice(list(self.SL))
+            query = ''.join(rng.choice('ACGT') for _ in range(rng.randint(0, 10))) + \
+                mutate(rng, self.SL[SL], rng.choice([0, 0.1, 0.3]))
+            aln = pool.align(SL, query)
+            if aln is None or aln.cigar_string is None:
+                continue
+            query_sw = query[aln.query_begin:aln.query_end + 1]
+            # cDNA slices the reference one base short, the last match reuses the previous base
+            for ref_end in [aln.ref_end + 1, aln.ref_end]:
+                ref = self.SL[SL][aln.ref_begin:ref_end]
+                if not ref:
+                    continue
+                self.assertEqual(DETECT.consensus(ref, query_sw, aln.cigar_string, 0),
+                                 char_consensus(ref, query_sw, aln.cigar_string))
+
+    def test_cigar_past_the_reference(self):
+        # one base past the end is compared with the last reference base, as cDNA has always done
+        self.assertEqual(DETECT.consensus('GGT', 'GGTT', '4M', 0), 'GGTT')
+        self.assertEqual(DETECT.consensus('GGT', 'GGTA', '4M', 0), 'GGTm')
+        with self.assertRaises(ValueError):
+            DETECT.consensus('', 'GG', '2M', 0)
+
+    def test_score_only_alignment_keeps_coordinates(self):
+        pool = DETECT.AlignerPool(self.SL)
+        rng = random.Random(1)
+        for _ in range(200):
+            query = ''.join(rng.choice('ACGT') for _ in range(rng.randint(5, 80)))
+            full = pool.align_all(query)
+            score_only = pool.align_all(query, report_cigar=False)
+            for SL in self.SL:
+                self.assertEqual([getattr(score_only[SL], name) for name in ['score', 'ref_begin', 'ref_end',
+                                                                              'query_begin', 'query_end']],
+                                 [getattr(full[SL], name) for name in ['score', 'ref_begin', 'ref_end',
+                                                                       'query_begin', 'query_end']])
+                self.assertIsNone(score_only[SL].cigar_string)
+
+
+@unittest.skipIf(DETECT is None, 'SL_detect dependencies are not installed')
+class CdnaEndsTests(unittest.TestCase):
+    SL = {'SL1': 'GGTTTAATTACCCAAGTTTGAG', 'SL2': 'GGTTTTAACCCAGTTACTCAAG'}
+
+    def test_missing_end_is_evaluated_once(self):
+        detector = DETECT.build_detector(dict(self.SL), 5)
+        reads = [['read1', ('ACGTGGTTTAATTACCCAAGTTTGAGAC', []), '+', 100],
+                 ['read2', ([], 'TTGGTTTTAACCCAGTTACTCAAGCA'), '-', 100],
+                 ['read3', ('ACGTACGTAC', 'ACGTACGTAC'), '+', 100],
+                 ['read4', ([], 'ACG'), '+', 100]]
+        detector['aligner_pool'] = DETECT.build_aligner_pool(detector['sl_dict'], detector['random_sequences_dict'])
+        missing_end_cache = {}
+        for item in reads:
+            expected, _ = DETECT.cdna_calculation_per_process(item, **detector)
+            mes, stats = DETECT.cdna_calculation_per_process(item, missing_end_cache=missing_end_cache, **detector)
+            self.assertEqual(mes, expected)
+        self.assertIn('result', missing_end_cache)
+
+
+@unittest.skipIf(DETECT is None, 'SL_detect dependencies are not installed')
+class ProfileTests(unittest.TestCase):
+    SL = {'SL1': 'GGTTTAATTACCCAAGTTTGAG', 'SL2': 'GGTTTTAACCCAGTTACTCAAG'}
+
+    def test_profiling_in_process_leaves_the_module_alone(self):
+        functions = [DETECT.find_best_match, DETECT.consensus, DETECT.select_sl, DETECT.format_sl_record]
+        detector = DETECT.build_detector(dict(self.SL), 5)
+        batch = [['read1', 'ACGTGGTTTAATTACCCAAGTTTGAGAC', '+', 100],
+                 ['read2', 'TTGGTTTTAACCCAGTTACTCAAGCA', '-', 100],
+                 ['read3', 'ACG', '+', 100]]
+        plain = DETECT.make_worker_state(DETECT.detector_settings(detector), 'RNA')
+        profiled = DETECT.make_worker_state(DETECT.detector_settings(detector, profile=True), 'RNA')
+        expected, _, _ = DETECT.score_batch(batch, 'RNA', plain)
+        rows, _, _ = DETECT.score_batch(batch, 'RNA', profiled)
+        self.assertEqual(rows, expected)
+        stats = profiled['profiler'].take()
+        for stage in ['sl_alignment', 'random_alignment', 'find_best_match', 'consensus', 'winner_selection']:
+            self.assertGreater(stats['profile_calls:' + stage], 0, stage)
+        self.assertEqual([DETECT.find_best_match, DETECT.consensus, DETECT.select_sl, DETECT.format_sl_record],
+                         functions)
+        self.assertNotIn('profiler', plain)
+
+
+@unittest.skipIf(DETECT is None, 'SL_detect dependencies are not installed')
+class NullTableTests(unittest.TestCase):
+    SL = {'SL1': 'GGTTTAATTACCCAAGTTTGAG', 'SL2': 'GGTTTTAACCCAGTTACTCAAG'}
+
+    def test_bins(self):
+        self.assertEqual(DETECT.null_bin('A'), (0, 0))
+        self.assertEqual(DETECT.null_bin('GGCAA'), (4, 3))
+        self.assertEqual(DETECT.null_bin('GC' * 5000), (len(DETECT.NULL_LENGTHS) - 1, DETECT.NULL_GC_BINS - 1))
+        self.assertFalse(DETECT.in_null_sample('ACGT', 0))
+        self.assertTrue(DETECT.in_null_sample('ACGT', 100))
+        self.assertFalse(DETECT.in_null_sample([], 100))
+
+    def test_validation_compares_with_random_alignments(self):
+        detector = DETECT.build_detector(dict(self.SL), 5)
+        aligner_pool = DETECT.build_aligner_pool(detector['sl_dict'], detector['random_sequences_dict'])
+        args = [aligner_pool] + [detector[name] for name in ['sl_dict', 'length_scores', 'random_sequences_dict',
+                                                             'random_seq_len', 'random_kmer_index', 'k', 'kmer_index']]
+        clip = 'ACGTTGGTTTAATTACCCAAGTTTGAGATG'
+        exact, exact_stats = DETECT.evaluate_clip(clip, 'RNA', *args)
+        # a table that never beats the SL score keeps the call, one that always does turns it random
+        bins = [[[0, 0, 0]] * DETECT.NULL_GC_BINS for _ in DETECT.NULL_LENGTHS]
+        table = {'RNA': bins, 'cDNA': bins}
+        result, stats = DETECT.evaluate_clip(clip, 'RNA', *args, null_table=table, null_validate=100)
+        self.assertEqual(result['SL_type'], exact['SL_type'])
+        self.assertEqual((stats['null_validated'], stats['null_changed']), (1, 0))
+        self.assertEqual(stats['random_alignments_skipped'], exact_stats['random_alignments_skipped'])
+        bins = [[[99, 99, 1000.0]] * DETECT.NULL_GC_BINS for _ in DETECT.NULL_LENGTHS]
+        table = {'RNA': bins, 'cDNA': bins}
+        result, stats = DETECT.evaluate_clip(clip, 'RNA', *args, null_table=table, null_validate=100)
+        self.assertEqual(result['SL_type'], 'random')
+        self.assertEqual(stats['null_changed'], int(exact['SL_type'] != 'random'))
+        result, stats = DETECT.evaluate_clip(clip, 'RNA', *args, null_table=table)
+        self.assertNotIn('null_validated', stats)
+        self.assertEqual(stats['random_alignments_skipped'], len(self.SL) * DETECT.RANDOM_SEQUENCES)
+
+
+@unittest.skipIf(DETECT is None, 'SL_detect dependencies are not installed')
+class ClipWindowTests(unittest.TestCase):
+    def test_reverse_complement_matches_bio(self):
+        rng = random.Random(826)
+        for _ in range(200):
+            seq = ''.join(rng.choice('ACGTNMRWSYKVHDBacgtn') for _ in range(rng.randint(0, 40)))
+            self.assertEqual(DETECT.reverse_complement(seq), str(Seq(seq).reverse_complement()))
+
+    def test_matches_soft_processed_on_full_read(self):
+        rng = random.Random(826)
+        for _ in range(500):
+            seq = ''.join(rng.choice('ACGTN') for _ in range(rng.randint(5, 60)))
+            cigar = [(rng.choice([0, 4]), rng.randint(1, 30)), (0, 20), (rng.choice([0, 4]), rng.randint(1, 30))]
+            for strand in '+-':
+                if strand == '-':
+                    full = str(Seq(seq).reverse_complement())
+                else:
+                    full = seq
+                self.assertEqual(DETECT.clip_window(seq, strand, cigar), soft_processed(full, strand, cigar))
+        self.assertEqual(DETECT.clip_window('ACGT', '+', []), '')
+
+    def test_capped_clip_reports_full_clip_coordinates(self):
+        SL = {'SL1': 'GGTTTAATTACCCAAGTTTGAG', 'SL2': 'GGTTTTAACCCAGTTACTCAAG'}
+        detector = DETECT.build_detector(dict(SL), 5)
+        detector['aligner_pool'] = DETECT.build_aligner_pool(detector['sl_dict'], detector['random_sequences_dict'])
+        # the SL sits next to the alignment, far from the start of a long adapter-like clip
+        clip = 'ACGTTGCATTGACCAGTAGGCATTACGGATCCATGA' + SL['SL1'] + 'AC'
+        for mode, item in [('RNA', ['read1', clip, '+', 100]), ('cDNA', ['read1', (clip, []), '+', 100])]:
+            if mode == 'RNA':
+                calculation = DETECT.drs_calculation_per_process
+            else:
+                calculation = DETECT.cdna_calculation_per_process
+            whole, _ = calculation(item, **detector)
+            capped, stats = calculation(item, max_clip=30, **detector)
+            self.assertEqual(stats['clip_bases_dropped'], len(clip) - 30)
+            whole, capped = whole.split('\t'), capped.split('\t')
+            # soft_length, read_end and query_length all refer to the whole clip
+            self.assertEqual(capped[2], str(len(clip)))
+            self.assertEqual(capped[4:6], whole[4:6])
+            self.assertEqual(capped[-1], 'SL1\n')
+        self.assertEqual(DETECT.shift_read_end('24\t22\tGG', 6), '30\t22\tGG')
+        self.assertEqual(DETECT.shift_read_end('24.0\tnan\tGG', 6), '30.0\tnan\tGG')
+
+    def test_cap_clip_keeps_the_alignment_side(self):
+        stats = {}
+        self.assertEqual(DETECT.cap_clip('ACGT', 0, stats), 'ACGT')
+        self.assertEqual(DETECT.cap_clip('ACGT', 4, stats), 'ACGT')
+        self.assertEqual(stats, {})
+        self.assertEqual(DETECT.cap_clip('AAAAAACGT', 4, stats), 'ACGT')
+        self.assertEqual(DETECT.cap_clip([], 4, stats), [])
+        self.assertEqual(stats, {'clip_truncated': 1, 'clip_bases_dropped': 5})
+
+
+@unittest.skipIf(DETECT is None, 'SL_detect dependencies are not installed')
+class RegionTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = random.Random(826)
+        reads = []
+        for i in range(300):
+            contig = rng.choice([0, 0, 0, 1])
+            reads.append(('read' + str(i), contig, rng.randint(0, 700), 'ACGT' * 30, [(4, 10), (0, 100), (4, 10)]))
+        self.bam_path = write_bam(os.path.join(self.tmp_dir, 'reads.bam'), reads,
+                                  [('chrI', 5000), ('chrII', 800), ('chrIII', 300)])
+        self.names = sorted(read[0] for read in reads)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_every_read_is_assigned_once(self):
+        regions = DETECT.plan_regions(self.bam_path, 8)
+        self.assertGreater(len(regions), 2)
+        self.assertNotIn('chrIII', [contig for _, contig, _, _ in regions])
+        names = []
+        with pysam.AlignmentFile(self.bam_path, 'rb') as bam_file:
+            for _, contig, start, end in regions:
+                names.extend(read.query_name for read in DETECT.region_reads(bam_file, contig, start, end))
+        self.assertEqual(sorted(names), self.names)
+
+    def test_stdin_stream_matches_indexed_bam(self):
+        # unsorted SAM with an unmapped record, as minimap2 writes it
+        sam_path = os.path.join(self.tmp_dir, 'reads.sam')
+        with pysam.AlignmentFile(self.bam_path, 'rb') as bam_file:
+            reads = list(bam_file.fetch())
+            random.Random(7).shuffle(reads)
+            with pysam.AlignmentFile(sam_path, 'w', template=bam_file) as out:
+                unmapped = pysam.AlignedSegment(out.header)
+                unmapped.query_name = 'unmapped'
+                unmapped.query_sequence = 'ACGT' * 30
+                unmapped.flag = 4
+                out.write(unmapped)
+                for read in reads:
+                    out.write(read)
+        code = ('from SLRanger import SL_detect as D\n'
+                'for item in D.read_bam(D.STDIN, "RNA"): print(repr(item))')
+        with open(sam_path) as sam:
+            stream = subprocess.run([sys.executable, '-c', code], stdin=sam, stdout=subprocess.PIPE,
+                                    check=True, universal_newlines=True).stdout
+        indexed = [repr(item) for item in DETECT.read_bam(self.bam_path, 'RNA')]
+        self.assertEqual(sorted(stream.splitlines()), sorted(indexed))
+
+
+@unittest.skipIf(DETECT is None, 'SL_detect dependencies are not installed')
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sl_path = write_sl_fasta(self.tmp_dir)
+        rng = random.Random(826)
+        self.bam_paths = []
+        for sample, n_reads in [('flowcell_1', 40), ('flowcell_2', 15)]:
+            reads = [clipped_read(sample + '_read' + str(i), i * 50,
+                                  rng.choice([SL_DICT['SL1'], SL_DICT['SL2'], 'ACGTTGCA']), random_seq(rng, 100))
+                     for i in range(n_reads)]
+            self.bam_paths.append(write_bam(os.path.join(self.tmp_dir, sample + '.bam'), reads))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_detect(self, *args, cwd=None):
+        script = os.path.join(os.path.dirname(DETECT.__file__), 'SL_detect.py')
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(DETECT.__file__)))
+        subprocess.run([sys.executable, script, '-r', self.sl_path, '-t', '2'] + list(args), env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=cwd)
+
+    def test_manifest(self):
+        manifest = os.path.join(self.tmp_dir, 'samples.tsv')
+        with open(manifest, 'w') as f:
+            f.write('# sample\tbam\n\nsecond\t' + self.bam_paths[1] + '\n')
+        self.assertEqual(DETECT.read_manifest(manifest), [('second', self.bam_paths[1])])
+        self.assertEqual(DETECT.sample_name('/data/flowcell_1.bam'), 'flowcell_1')
+
+    def test_batch_matches_single_runs(self):
+        for by_region in [[], ['--by-region']]:
+            out_dir = os.path.join(self.tmp_dir, 'batch' + str(len(by_region)))
+            manifest = os.path.join(self.tmp_dir, 'samples.tsv')
+            with open(manifest, 'w') as f:
+                f.write('second\t' + self.bam_paths[1] + '\n')
+            self.run_detect('-i', self.bam_paths[0], '--manifest', manifest, '-o', out_dir, '--chunk-size', '7',
+                            *by_region)
+            for sample, bam_path in [('flowcell_1', self.bam_paths[0]), ('second', self.bam_paths[1])]:
+                single = os.path.join(self.tmp_dir, sample + '.txt')
+                self.run_detect('-i', bam_path, '-o', single, *by_region)
+                with open(single) as expected, open(os.path.join(out_dir, sample + '.txt')) as result:
+                    self.assertEqual(result.read(), expected.read())
+            summary = pd.read_csv(os.path.join(out_dir, 'summary.tsv'), sep='\t', keep_default_na=False)
+            self.assertEqual(list(summary['sample']), ['flowcell_1', 'second', 'total'])
+            self.assertEqual(list(summary['reads']), [40, 15, 55])
+            counts = summary[['SL1', 'SL2', 'unknown', 'random']].sum(axis=1)
+            self.assertEqual(list(counts), [40, 15, 55])
+
+    def test_default_output_directory(self):
+        self.run_detect('-i', *self.bam_paths, cwd=self.tmp_dir)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp_dir, 'SLRanger_batch'))),
+                         ['flowcell_1.txt', 'flowcell_2.txt', 'summary.tsv'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'SLRanger_ppssw.txt')))
+
+
+
+@unittest.skipIf(DETECT is None, 'SL_detect dependencies are not installed')
+class MergeCommandTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_unfinished_partial_is_a_usage_error(self):
+        partial = os.path.join(self.tmp_dir, 'part1.txt')
+        with open(partial, 'w') as f:
+            f.write(DETECT.RESULT_HEADER)
+        script = os.path.join(os.path.dirname(DETECT.__file__), 'SL_detect.py')
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(DETECT.__file__)))
+        merge = subprocess.run([sys.executable, script, 'merge', partial, '-o', os.path.join(self.tmp_dir, 'out.txt')],
+                               env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(merge.returncode, 2)
+        self.assertIn('SL_detect.py merge: error: ' + partial + ' has no part1.txt.shard.json', merge.stderr)
+        self.assertNotIn('Traceback', merge.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from SLRanger.sl_index import load_index, pack_kmer_index, unpack_kmer_index
+
+try:
+    from SLRanger import SL_detect as DETECT
+    from SLRanger.shard import sl_checksum
+except ImportError:  # pysam / pyssw are not installed in the packaging job
+    DETECT = None
+
+
+SL_DICT = {'SL1': 'GGTTTAATTACCCAAGTTTGAG', 'SL2': 'GGTTTTAACCCAGTTACTCAAG', 'SL2a': 'GGTTTATACCCAGTTAACCAAG'}
+
+
+class KmerTableTests(unittest.TestCase):
+    def test_pack_round_trip(self):
+        kmer_index = [None] * 16
+        kmer_index[3] = (0,)
+        kmer_index[7] = (2, 9, 17)
+        offsets, positions = pack_kmer_index(kmer_index)
+        self.assertEqual(unpack_kmer_index(memoryview(offsets).cast('I'), memoryview(positions).cast('H')),
+                         kmer_index)
+
+
+@unittest.skipIf(DETECT is None, 'pysam/pyssw are not installed')
+class SLIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'SL.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_loaded_state_equals_built_state(self):
+        parameters = DETECT.index_parameters(5)
+        state = DETECT.build_detector(dict(SL_DICT), 5)
+        DETECT.write_index(self.path, state, sl_checksum(SL_DICT), parameters)
+        self.assertEqual(load_index(self.path, sl_checksum(SL_DICT), parameters), state)
+
+    def test_other_references_are_rejected(self):
+        parameters = DETECT.index_parameters(5)
+        DETECT.write_index(self.path, DETECT.build_detector(dict(SL_DICT), 5), sl_checksum(SL_DICT), parameters)
+        other = dict(SL_DICT, SL3='GGTTTTTACCCAGTATCTCAAG')
+        with self.assertRaises(ValueError):
+            load_index(self.path, sl_checksum(other), parameters)
+        with self.assertRaises(ValueError):
+            load_index(self.path, sl_checksum(SL_DICT), DETECT.index_parameters(4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+from SLRanger.sorted_writer import SortedResultWriter
+
+
+class SortedResultWriterTests(unittest.TestCase):
+    def test_rows_are_merged_in_name_order(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp = Path(temp_dir)
+            output = temp / 'out.tsv'
+            writer = SortedResultWriter(str(output), 'query_name\tSL_type\n', tmp_dir=temp_dir, buffer_rows=3)
+            names = ['read' + str(i) for i in [7, 3, 11, 0, 5, 9, 1, 2, 10, 4, 8, 6]]
+            for start in range(0, len(names), 5):
+                writer.write(''.join(name + '\tSL1\n' for name in names[start:start + 5]))
+            writer.close()
+            lines = output.read_text().splitlines()
+            self.assertEqual(lines[0], 'query_name\tSL_type')
+            self.assertEqual([line.split('\t')[0] for line in lines[1:]], sorted(names))
+            self.assertEqual([path.name for path in temp.iterdir()], ['out.tsv'])
+
+    def test_abort_leaves_no_output(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp = Path(temp_dir)
+            writer = SortedResultWriter(str(temp / 'out.tsv'), 'query_name\n', tmp_dir=temp_dir)
+            writer.write('read1\n')
+            writer.abort()
+            self.assertEqual(list(temp.iterdir()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()